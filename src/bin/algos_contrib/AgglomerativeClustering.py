@@ -1,11 +1,38 @@
+import errno
+import hashlib
+import os
+
 import numpy as np
+import scipy.sparse as sp
 from sklearn.cluster import AgglomerativeClustering as AgClustering
-from sklearn.metrics import silhouette_samples
+from sklearn.cluster import Birch
+from sklearn.cluster import linkage_tree, ward_tree
+from sklearn.metrics import pairwise_distances, pairwise_distances_argmin
+from sklearn.neighbors import kneighbors_graph
 
 from base import BaseAlgo
+from cexc import get_logger
+from codec import codecs_manager
 from util.param_util import convert_params
 from util import df_util
 
+# Number of distances held in memory at once while computing silhouettes
+SILHOUETTE_CELLS = 2 ** 22
+
+# Merge trees saved by cache_tree=true, keyed by a fingerprint of the data and the linkage parameters.
+# Only the TREE_CACHE_SIZE most recently used trees are kept.
+TREE_CACHE_SIZE = 16
+
+logger = get_logger('AgglomerativeClustering')
+
+
+def tree_cache_dir():
+    """Private cache directory under $SPLUNK_HOME/var, None when SPLUNK_HOME is not set."""
+    splunk_home = os.environ.get('SPLUNK_HOME')
+    if not splunk_home:
+        return None
+    return os.path.join(splunk_home, 'var', 'run', 'splunk', 'mltk_agglomerative_trees')
+
 
 class AgglomerativeClustering(BaseAlgo):
     """Use scikit-learn's AgglomerativeClustering algorithm to cluster data."""
@@ -27,11 +54,57 @@ class AgglomerativeClustering(BaseAlgo):
         params = options.get('params', {})
         out_params = convert_params(
             params,
-            ints=['k'],
-            strs=['linkage', 'affinity'],
+            ints=['k', 'silhouette_sample_size', 'random_state', 'n_neighbors', 'micro_clusters'],
+            floats=['distance_threshold', 'birch_threshold'],
+            bools=['cache_tree'],
+            strs=['linkage', 'affinity', 'silhouette'],
             aliases={'k': 'n_clusters'}
         )
 
+        # off: labels only, exact: all pairwise distances in row chunks,
+        # sampled: distances to at most silhouette_sample_size random points of each cluster,
+        # the default with micro_clusters since exact silhouettes are quadratic in the number of rows
+        default_silhouette = 'exact' if out_params.get('micro_clusters') is None else 'sampled'
+        self.silhouette = out_params.pop('silhouette', default_silhouette)
+        valid_silhouette = ['off', 'exact', 'sampled']
+        if self.silhouette not in valid_silhouette:
+            raise RuntimeError('silhouette must be one of: {}'.format(', '.join(valid_silhouette)))
+
+        self.silhouette_sample_size = out_params.pop('silhouette_sample_size', 100)
+        if self.silhouette_sample_size <= 0:
+            raise RuntimeError('Invalid value error: silhouette_sample_size must be greater than 0, '
+                               'but found silhouette_sample_size="{}".'.format(self.silhouette_sample_size))
+        self.random_state = out_params.pop('random_state', None)
+
+        # Restrict merges to the edges of a k nearest neighbours graph
+        self.n_neighbors = out_params.pop('n_neighbors', None)
+        if self.n_neighbors is not None and self.n_neighbors <= 0:
+            raise RuntimeError('Invalid value error: n_neighbors must be greater than 0, '
+                               'but found n_neighbors="{}".'.format(self.n_neighbors))
+
+        # The full merge tree is built once and cut at k clusters or at distance_threshold,
+        # with cache_tree it is reused by later runs on the same data
+        self.distance_threshold = out_params.pop('distance_threshold', None)
+        self.cache_tree = out_params.pop('cache_tree', False)
+        if self.distance_threshold is not None and 'n_clusters' in out_params:
+            raise RuntimeError('k and distance_threshold can not be used together')
+        if self.distance_threshold is not None and self.distance_threshold < 0:
+            raise RuntimeError('Invalid value error: distance_threshold must be at least 0, '
+                               'but found distance_threshold="{}".'.format(self.distance_threshold))
+
+        # Summarize the rows into at most micro_clusters BIRCH subclusters and cluster those
+        self.micro_clusters = out_params.pop('micro_clusters', None)
+        self.birch_threshold = out_params.pop('birch_threshold', 0.5)
+        if self.micro_clusters is not None:
+            if self.micro_clusters <= 0:
+                raise RuntimeError('Invalid value error: micro_clusters must be greater than 0, '
+                                   'but found micro_clusters="{}".'.format(self.micro_clusters))
+            if self.birch_threshold <= 0:
+                raise RuntimeError('Invalid value error: birch_threshold must be greater than 0, '
+                                   'but found birch_threshold="{}".'.format(self.birch_threshold))
+            if out_params.get('affinity') == 'precomputed':
+                raise RuntimeError('micro_clusters can not be used with affinity=precomputed')
+
         # Check for valid linkage
         if 'linkage' in out_params:
             valid_linkage = ['ward', 'complete', 'average']
@@ -64,16 +137,33 @@ class AgglomerativeClustering(BaseAlgo):
         # - drop null columns & rows
         # - convert categorical columns into dummy indicator columns
         # X is our cleaned data, nans is a mask of the null value locations
-        X, nans, columns = df_util.prepare_features(X, self.feature_variables)
+        X, nans, self.columns = df_util.prepare_features(X, self.feature_variables)
+
+        # The linkage runs on the micro-cluster centroids, each row then takes the label of its micro-cluster
+        points = X.values
+        if self.micro_clusters is not None:
+            assignment, points = birch_micro_clusters(X.values, self.micro_clusters, self.birch_threshold)
 
         # Do the actual clustering
-        y_hat = self.estimator.fit_predict(X.values)
+        if self.cache_tree or self.distance_threshold is not None:
+            children, distances = self.merge_tree(points)
+            if self.distance_threshold is not None:
+                n_clusters = np.count_nonzero(distances >= self.distance_threshold) + 1
+            else:
+                n_clusters = self.estimator.n_clusters
+            y_hat = cut_tree(children, n_clusters)
+        else:
+            if self.n_neighbors is not None:
+                self.estimator.set_params(connectivity=self.connectivity_graph(points))
+            y_hat = self.estimator.fit_predict(points)
 
-        # attach silhouette coefficient score for each row
-        silhouettes = silhouette_samples(X, y_hat)
+        if self.micro_clusters is not None:
+            y_hat = y_hat[assignment]
 
-        # Combine the two arrays, and transpose them.
-        y_hat = np.vstack([y_hat, silhouettes]).T
+        # The saved model only keeps what apply needs, the fitted estimator holds the whole merge tree
+        self.affinity = self.estimator.affinity
+        self.centroids = cluster_centroids(X.values, y_hat) if self.affinity != 'precomputed' else None
+        self.estimator = None
 
         # Assign default output names
         default_name = 'cluster'
@@ -81,8 +171,19 @@ class AgglomerativeClustering(BaseAlgo):
         # Get the value from the as-clause if present
         output_name = options.get('output_name', default_name)
 
-        # There are two columns - one for the labels, for the silhouette scores
-        output_names = [output_name, 'silhouette_score']
+        if self.silhouette == 'off':
+            y_hat = y_hat.reshape(-1, 1)
+            output_names = [output_name]
+        else:
+            # attach silhouette coefficient score for each row
+            sample_size = self.silhouette_sample_size if self.silhouette == 'sampled' else None
+            silhouettes = silhouette_scores(X.values, y_hat, sample_size, self.random_state)
+
+            # Combine the two arrays, and transpose them.
+            y_hat = np.vstack([y_hat, silhouettes]).T
+
+            # There are two columns - one for the labels, for the silhouette scores
+            output_names = [output_name, 'silhouette_score']
 
         # Use the predictions & nans-mask to create a new dataframe
         output_df = df_util.create_output_dataframe(y_hat, nans, output_names)
@@ -90,3 +191,220 @@ class AgglomerativeClustering(BaseAlgo):
         # Merge the dataframe with the original input data
         df = df_util.merge_predictions(df, output_df)
         return df
+
+    def apply(self, df, options):
+        """Assign each row to the cluster with the nearest centroid."""
+        if self.centroids is None:
+            raise RuntimeError('Models fitted with affinity=precomputed can not be applied to new data')
+
+        # Make a copy of the input data
+        X = df.copy()
+
+        X, nans, _ = df_util.prepare_features(
+            X=X,
+            variables=self.feature_variables,
+            final_columns=self.columns,
+            mlspl_limits=options.get('mlspl_limits'),
+        )
+
+        metric = {'l1': 'manhattan', 'l2': 'euclidean'}.get(self.affinity, self.affinity)
+        y_hat = pairwise_distances_argmin(X.values, self.centroids, metric=metric)
+
+        output_name = options.get('output_name', 'cluster')
+        output_df = df_util.create_output_dataframe(y_hat.reshape(-1, 1), nans, [output_name])
+        df = df_util.merge_predictions(df, output_df)
+        return df
+
+    @staticmethod
+    def register_codecs():
+        from codec.codecs import SimpleObjectCodec
+        codecs_manager.add_codec('algos_contrib.AgglomerativeClustering', 'AgglomerativeClustering', SimpleObjectCodec)
+
+    def merge_tree(self, X):
+        """Children and merge distances of the full dendrogram of X, read from the cache when possible."""
+        cache_dir = tree_cache_dir() if self.cache_tree else None
+        if self.cache_tree and cache_dir is None:
+            logger.warning('cache_tree is ignored because SPLUNK_HOME is not set')
+        if cache_dir is not None:
+            X = np.ascontiguousarray(X, dtype=np.float64)
+            fingerprint = hashlib.sha1(X.tobytes())
+            fingerprint.update(repr((X.shape, self.estimator.linkage, self.estimator.affinity,
+                                     self.n_neighbors)).encode('utf-8'))
+            key = fingerprint.hexdigest()
+            cached = read_cached_tree(cache_dir, key)
+            if cached is not None:
+                return cached
+
+        connectivity = None
+        if self.n_neighbors is not None:
+            connectivity = self.connectivity_graph(X)
+        if self.estimator.linkage == 'ward':
+            tree = ward_tree(X, connectivity=connectivity, return_distance=True)
+        else:
+            tree = linkage_tree(X, connectivity=connectivity, linkage=self.estimator.linkage,
+                                affinity=self.estimator.affinity, return_distance=True)
+        children, distances = tree[0], tree[-1]
+
+        if cache_dir is not None:
+            write_cached_tree(cache_dir, key, children, distances)
+        return children, distances
+
+    def connectivity_graph(self, X):
+        """Sparse k nearest neighbours graph of X under the clustering affinity."""
+        affinity = self.estimator.affinity
+        metric = {'l1': 'manhattan', 'l2': 'euclidean'}.get(affinity, affinity)
+        if len(X) < 2:
+            raise RuntimeError('n_neighbors requires at least 2 points to cluster, but found {}'.format(len(X)))
+        n_neighbors = min(self.n_neighbors, len(X) - 1)
+        return kneighbors_graph(X, n_neighbors, metric=metric, include_self=False)
+
+
+def read_cached_tree(cache_dir, key):
+    """Children and distances cached under key, None when missing or unreadable."""
+    path = os.path.join(cache_dir, key + '.npz')
+    try:
+        # allow_pickle=False: the cache only ever holds plain integer and float arrays
+        with np.load(path, allow_pickle=False) as cached:
+            children, distances = cached['children'], cached['distances']
+        # Mark the tree as recently used
+        os.utime(path, None)
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+    return children, distances
+
+
+def write_cached_tree(cache_dir, key, children, distances):
+    """Cache a tree under key, then drop the least recently used trees beyond TREE_CACHE_SIZE."""
+    try:
+        os.makedirs(cache_dir, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            logger.warning('Can not create the tree cache %s: %s', cache_dir, e)
+            return
+
+    # Write then rename so a concurrent search never reads a partial file
+    path = os.path.join(cache_dir, key + '.npz')
+    partial = os.path.join(cache_dir, '{}.{}.partial'.format(key, os.getpid()))
+    try:
+        with open(partial, 'wb') as f:
+            np.savez(f, children=children, distances=distances)
+        try:
+            os.rename(partial, path)
+        except OSError:
+            # On Windows rename does not replace, another search already cached the same tree
+            os.remove(partial)
+    except (IOError, OSError) as e:
+        logger.warning('Can not write the tree cache %s: %s', path, e)
+        return
+
+    try:
+        paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith('.npz')]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for old in paths[TREE_CACHE_SIZE:]:
+            os.remove(old)
+    except OSError:
+        # Another search may be evicting at the same time
+        pass
+
+
+def birch_micro_clusters(X, max_clusters, threshold):
+    """Summarize X into at most max_clusters micro-clusters with a BIRCH CF-tree.
+
+    While the tree has too many subclusters it is rebuilt from their centers with a doubled threshold.
+    Returns the micro-cluster of each row and the micro-cluster centroids.
+    """
+    centers = X
+    while True:
+        birch = Birch(threshold=threshold, n_clusters=None, compute_labels=False).fit(centers)
+        centers = birch.subcluster_centers_
+        if len(centers) <= max_clusters:
+            break
+        threshold *= 2
+
+    # Rows go to the nearest center, the centroids are then the means of the rows they got
+    _, assignment = np.unique(pairwise_distances_argmin(X, centers), return_inverse=True)
+    return assignment, cluster_centroids(X, assignment)
+
+
+def cluster_centroids(X, labels):
+    """Mean of the rows of each cluster, row i is the centroid of label i."""
+    n_clusters = labels.max() + 1
+    membership = sp.csr_matrix((np.ones(len(labels)), (labels, np.arange(len(labels)))),
+                               shape=(n_clusters, len(labels)))
+    counts = np.bincount(labels, minlength=n_clusters).astype(float)
+    return np.asarray(membership.dot(X)) / counts[:, np.newaxis]
+
+
+def cut_tree(children, n_clusters):
+    """Labels of the leaves after applying the first n_leaves - n_clusters merges of the tree."""
+    n_leaves = len(children) + 1
+    n_merges = n_leaves - min(max(n_clusters, 1), n_leaves)
+
+    # Point every merged node at the node it was merged into, then follow the pointers to the roots
+    parent = np.arange(n_leaves + n_merges)
+    parent[np.asarray(children[:n_merges]).ravel()] = np.repeat(np.arange(n_leaves, n_leaves + n_merges), 2)
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        parent = grandparent
+
+    _, labels = np.unique(parent[:n_leaves], return_inverse=True)
+    return labels
+
+
+def silhouette_scores(X, labels, sample_size=None, random_state=None):
+    """Silhouette coefficient of each row, computed in row chunks of at most SILHOUETTE_CELLS distances.
+
+    Without sample_size this matches sklearn's silhouette_samples. With sample_size, the mean distance
+    to each cluster is estimated from at most sample_size random members of that cluster.
+    """
+    _, labels = np.unique(labels, return_inverse=True)
+    n_clusters = labels.max() + 1
+    if n_clusters < 2:
+        raise RuntimeError('silhouette requires at least 2 clusters')
+    cluster_sizes = np.bincount(labels)
+
+    if sample_size is None:
+        references = np.arange(len(X))
+    else:
+        rng = np.random.RandomState(random_state)
+        references = []
+        for cluster in range(n_clusters):
+            members = np.flatnonzero(labels == cluster)
+            if len(members) > sample_size:
+                members = np.sort(rng.choice(members, sample_size, replace=False))
+            references.append(members)
+        references = np.concatenate(references)
+
+    reference_labels = labels[references]
+    membership = sp.csr_matrix(
+        (np.ones(len(references)), (reference_labels, np.arange(len(references)))),
+        shape=(n_clusters, len(references)))
+    reference_counts = np.bincount(reference_labels, minlength=n_clusters).astype(float)
+    is_reference = np.zeros(len(X), dtype=bool)
+    is_reference[references] = True
+
+    scores = np.empty(len(X))
+    step = max(1, SILHOUETTE_CELLS // len(references))
+    for start in range(0, len(X), step):
+        rows = np.arange(start, min(start + step, len(X)))
+        own = labels[rows]
+
+        # Summed distance to the references of each cluster, a row is never its own reference
+        sums = np.asarray(membership.dot(pairwise_distances(X[references], X[rows]))).T
+        counts = np.tile(reference_counts, (len(rows), 1))
+        counts[np.arange(len(rows)), own] -= is_reference[rows]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = sums / counts
+        a = means[np.arange(len(rows)), own]
+        means[np.arange(len(rows)), own] = np.inf
+        b = means.min(axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chunk_scores = (b - a) / np.maximum(a, b)
+        # Rows alone in their cluster, or at distance 0 from everything, score 0
+        chunk_scores[(cluster_sizes[own] == 1) | ~np.isfinite(chunk_scores)] = 0
+        scores[rows] = chunk_scores
+    return scores
@@ -2,8 +2,14 @@
 from base import BaseAlgo
 import pandas as pd
 import numpy as np
+import scipy.sparse as sp
+from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
-from sklearn.metrics.pairwise import pairwise_distances
+from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+from codec import codecs_manager
 from cexc import get_logger
 from util import df_util
 from util.param_util import convert_params
@@ -15,11 +21,59 @@ from util.param_util import convert_params
 # TODO currently we assume a |fillnull value=0 is run in splunk prior to calling the algorithm
 
 # We ASSUME rows are users, columns are items. 
-# TODO I seem to cause splunk memory issues with wide tables, so I should consider doing an XYSERIES like reshape 
-# TODO and consider taking in a table of USERID, ITEM , RATING from splunk. Yucky.
+# Wide tables cause splunk memory issues, so when item_field and rating_field are given we instead take in a
+# long table of USERID, ITEM, RATING from splunk and keep the ratings in a scipy.sparse CSR matrix.
+# Memory is then proportional to the number of observed ratings rather than users x items.
+
+# With k_neighbors the similarities are computed in blocks of rows and only each row's top k neighbours are kept,
+# so peak memory is bounded by the block size and k instead of n x n.
+
+# lsh_tables adds a random hyperplane locality sensitive hashing index: candidate neighbours are the rows sharing a
+# lsh_bits signature in at least one table, and exact cosine is only computed for the candidates. More tables raise
+# recall, more bits give smaller buckets but drop neighbours that are not very similar. The hyperplanes are drawn in
+# chunks of input columns, so their memory stays bounded when the columns are users (rating_type=item).
+# Recall@10 and fit seconds against the exact top k (k_neighbors=10, 20000 users x 5000 items, tests/bench_lsh.py),
+# for neighbours of cosine ~0.5 / ~0.8:
+#
+#   tables bits    recall       seconds
+#    exact         1.00 / 1.00  13.4 /  9.3
+#       16    4    0.93 / 1.00  20.4 / 21.3
+#        8    6    0.42 / 0.78   5.0 /  6.2
+#       16    6    0.64 / 0.95  10.9 /  9.9
+#       16    8    0.33 / 0.79  12.9 / 12.4
+#       32    8    0.55 / 0.95  17.0 / 22.5
+#       32   12    0.13 / 0.61  12.0 / 14.7
+#
+# The exact blocked path is already sparse, so lsh only pays off for very large inputs whose neighbours are highly
+# similar; lsh_bits defaults to 6, with 16 tables for ~0.95 recall on such neighbours.
+
+# The fitted ratings and neighbourhood are saved with the model, so apply serves the top_n unseen items per user
+# in long format (one row per user and recommendation) without recomputing any similarity.
+
+# partial_fit (rating_type=item on long input) accumulates the item x item co-occurrence dot products, whose diagonal
+# holds the squared item norms. These are the sufficient statistics of cosine similarity, and the neighbourhood is
+# derived from them lazily in apply, so new events are folded in without refitting the whole history.
+
+# rating_type=als learns low rank user and item factors with alternating least squares instead, fit cost is linear
+# in the number of observed ratings and the saved model is two small factor matrices.
 
 # TODO There are many many many other distance metrics that could be a good fit.
 
+# upper bound on the number of similarities computed at once when truncating to the top k neighbours
+SIMILARITY_CELLS = 2 ** 22
+
+# upper bound on the number of predicted ratings scored at once in apply
+APPLY_CELLS = 2 ** 22
+
+# candidate pairs scored and merged into the running top k at once by the lsh index
+LSH_PAIRS = 2 ** 20
+
+# lsh buckets of at least this many rows are scored with a sparse product rather than pair by pair
+LSH_DENSE_BUCKET = 64
+
+# upper bound on the size of the stacked factors x factors systems solved at once by als
+ALS_CELLS = 2 ** 22
+
 
 class CollaborativeFilter(BaseAlgo):
     def __init__(self, options):
@@ -29,7 +83,9 @@ class CollaborativeFilter(BaseAlgo):
         params = options.get('params', {})
         out_params = convert_params(
             params,
-            strs=['user_field','rating_type','coldstart_field']
+            ints=['k_neighbors','top_n','factors','iterations','n_jobs','random_state','lsh_tables','lsh_bits'],
+            floats=['regularization'],
+            strs=['user_field','item_field','rating_field','rating_type','coldstart_field']
         )
 
         # set defaults for parameters
@@ -44,7 +100,68 @@ class CollaborativeFilter(BaseAlgo):
                 self.rating_type="item"
             elif out_params['rating_type'] == "user":
                 self.rating_type="user"
+            elif out_params['rating_type'] == "als":
+                self.rating_type="als"
+
+        # long format (user, item, rating) input needs both the item and the rating field
+        self.item_field = out_params.get('item_field')
+        self.rating_field = out_params.get('rating_field')
+        if (self.item_field is None) != (self.rating_field is None):
+            raise RuntimeError('item_field and rating_field must be specified together')
+
+        self.k_neighbors = out_params.get('k_neighbors')
+        if self.k_neighbors is not None and self.k_neighbors <= 0:
+            msg = 'Invalid value error: k_neighbors must be greater than 0, but found k_neighbors="{}".'
+            raise RuntimeError(msg.format(self.k_neighbors))
+
+        self.top_n = out_params.get('top_n', 10)
+        if self.top_n <= 0:
+            msg = 'Invalid value error: top_n must be greater than 0, but found top_n="{}".'
+            raise RuntimeError(msg.format(self.top_n))
+
+        # alternating least squares
+        self.factors = out_params.get('factors', 10)
+        if self.factors <= 0:
+            msg = 'Invalid value error: factors must be greater than 0, but found factors="{}".'
+            raise RuntimeError(msg.format(self.factors))
+
+        self.iterations = out_params.get('iterations', 10)
+        if self.iterations <= 0:
+            msg = 'Invalid value error: iterations must be greater than 0, but found iterations="{}".'
+            raise RuntimeError(msg.format(self.iterations))
+
+        self.regularization = out_params.get('regularization', 0.1)
+        # a positive ridge keeps the normal equations of sparsely rated users and items solvable
+        if self.regularization <= 0:
+            msg = 'Invalid value error: regularization must be greater than 0, but found regularization="{}".'
+            raise RuntimeError(msg.format(self.regularization))
+
+        self.n_jobs = out_params.get('n_jobs', 1)
+        if self.n_jobs == 0:
+            raise RuntimeError('Invalid value error: n_jobs must not be 0, use -1 for all cores.')
+
+        self.random_state = out_params.get('random_state')
+
+        # approximate neighbours
+        self.lsh_tables = out_params.get('lsh_tables')
+        if self.lsh_tables is not None:
+            if self.lsh_tables <= 0:
+                msg = 'Invalid value error: lsh_tables must be greater than 0, but found lsh_tables="{}".'
+                raise RuntimeError(msg.format(self.lsh_tables))
+            if self.k_neighbors is None:
+                raise RuntimeError('lsh_tables requires k_neighbors')
 
+        self.lsh_bits = out_params.get('lsh_bits', 6)
+        if not 0 < self.lsh_bits <= 62:
+            msg = 'Invalid value error: lsh_bits must be between 1 and 62, but found lsh_bits="{}".'
+            raise RuntimeError(msg.format(self.lsh_bits))
+
+        # fitted model
+        self.ratings = None
+        self.neighbours = None
+        self.cooccurrence = None
+        self.users = []
+        self.items = []
 
     def fit(self, df, options):
         # df contains all the search results, including hidden fields
@@ -73,6 +190,11 @@ class CollaborativeFilter(BaseAlgo):
         except:
             raise RuntimeError('You must specify user field that exists. You sent %s',self.user_field)
 
+        if self.item_field is not None:
+            # nothing returned, so apply serves the recommendations for the fitted users
+            self._fit_long(X)
+            return
+
         X=X.drop([self.user_field],axis=1)
         my_list_header=(X.columns.values)
 
@@ -82,18 +204,36 @@ class CollaborativeFilter(BaseAlgo):
         # force type for Numpy Math
         matrix=matrix.astype(np.float64)
 
+        # predict from the sparse top k neighbourhood or the als factors,
+        # unobserved (zero) ratings are left out of the user means
+        if self.k_neighbors is not None or self.rating_type == "als":
+            self._fit_model(sp.csr_matrix(matrix), my_list_index, my_list_header)
+            predicted = self._predictor()(None)
+            if sp.issparse(predicted):
+                predicted = predicted.toarray()
+            output_df=pd.DataFrame(predicted,columns=my_list_header, index=my_list_index)
+            output_df[self.user_field]=pd.Series(my_list_index).values
+            return output_df
+
         # should consider erroring out when you have super sparse user data
         # TODO add other methods via parameter
-        user_sim = pairwise_distances(matrix, metric='cosine')
-        item_sim = pairwise_distances(matrix.T, metric='cosine')
+        # weight by cosine similarity, as the stored neighbourhood used by apply does
+        user_sim = cosine_similarity(matrix)
+        item_sim = cosine_similarity(matrix.T)
+
+        self._store_model(
+            sp.csr_matrix(matrix), my_list_index, my_list_header,
+            item_sim if self.rating_type == "item" else user_sim,
+        )
 
-        #item prediction
-        item_sim= matrix.dot(item_sim) / np.array([np.abs(item_sim).sum(axis=1)])
+        #item prediction, an unrated item has no similar items and is predicted 0
+        item_sim= matrix.dot(item_sim) * _inverse(np.abs(item_sim).sum(axis=1)).diagonal()
 
         #user sim
         mean_user_rating = matrix.mean(axis=1)
         matrix_diff = (matrix - mean_user_rating[:, np.newaxis])
-        user_sim = mean_user_rating[:, np.newaxis] + user_sim.dot(matrix_diff) / np.array([np.abs(user_sim).sum(axis=1)]).T
+        user_weights = _inverse(np.abs(user_sim).sum(axis=1)).diagonal()[:, np.newaxis]
+        user_sim = mean_user_rating[:, np.newaxis] + user_sim.dot(matrix_diff) * user_weights
 
         # add back into the matrix the header row
         if self.rating_type == "item":
@@ -102,8 +242,601 @@ class CollaborativeFilter(BaseAlgo):
             output_df=pd.DataFrame(user_sim,columns=my_list_header, index=my_list_index)        
         output_df[self.user_field]=pd.Series(my_list_index).values
 
-        return output_df  
-        
+        return output_df
 
- 
+    def _fit_long(self, X):
+        """Sparse engine for a long table of (user, item, rating) events."""
+        for field in (self.item_field, self.rating_field):
+            if field not in X:
+                raise RuntimeError('You must specify fields that exist. You sent %s' % field)
+
+        matrix, users, items = _ratings_matrix(
+            X[self.user_field].values, X[self.item_field].values, X[self.rating_field].values)
+        self._fit_model(matrix, users, items)
+
+    def partial_fit(self, df, options):
+        """Fold a chunk of (user, item, rating) events into the ratings and the item co-occurrence."""
+        if self.item_field is None or self.rating_type != "item":
+            raise RuntimeError('partial_fit requires item_field, rating_field and rating_type=item')
+
+        X, _, self.columns = df_util.prepare_features(
+            X=df.copy(),
+            variables=self.feature_variables,
+            get_dummies=False,
+            mlspl_limits=options.get('mlspl_limits'),
+        )
+        for field in (self.user_field, self.item_field, self.rating_field):
+            if field not in X:
+                raise RuntimeError('You must specify fields that exist. You sent %s' % field)
+
+        chunk, users, items = _ratings_matrix(
+            X[self.user_field].values, X[self.item_field].values, X[self.rating_field].values)
+
+        # place the chunk in the global user x item index, new labels are appended
+        user_rows = _extend_labels(self.users, users)
+        item_columns = _extend_labels(self.items, items)
+        shape = (len(self.users), len(self.items))
+        chunk = chunk.tocoo()
+        delta = sp.coo_matrix(
+            (chunk.data, (user_rows[chunk.row], item_columns[chunk.col])), shape=shape).tocsr()
+
+        if self.ratings is None:
+            self.ratings = sp.csr_matrix(shape)
+        ratings = _grow(self.ratings, shape)
+        if self.cooccurrence is None:
+            cooccurrence = ratings.T.dot(ratings).tocsr()
+        else:
+            cooccurrence = _grow(self.cooccurrence, (shape[1], shape[1]))
+
+        # (R + D)^T (R + D) = R^T R + R^T D + D^T R + D^T D, only the users in the chunk contribute
+        touched = np.flatnonzero(np.diff(delta.indptr))
+        old, new = ratings[touched], delta[touched]
+        cross = old.T.dot(new)
+        self.cooccurrence = (cooccurrence + cross + cross.T + new.T.dot(new)).tocsr()
+        self.ratings = (ratings + delta).tocsr()
+
+        # similarities are derived lazily in apply
+        self.neighbours = None
+
+    def _fit_model(self, matrix, users, items):
+        """Compute and keep the neighbourhood or the factors of a sparse users x items matrix."""
+        neighbours = None
+        if self.rating_type == "item":
+            neighbours = self._similarity(matrix.T)
+        elif self.rating_type == "user":
+            neighbours = self._similarity(matrix)
+        else:
+            n_jobs = self.n_jobs
+            if n_jobs < 0:
+                n_jobs = max(1, cpu_count() + 1 + n_jobs)
+            self.user_factors, self.item_factors = _als(
+                matrix, self.factors, self.regularization, self.iterations, n_jobs, self.random_state)
+        self._store_model(matrix, users, items, neighbours)
+
+    def _store_model(self, matrix, users, items, neighbours):
+        """Keep everything apply needs, labels are kept as strings."""
+        if neighbours is not None:
+            neighbours = sp.csr_matrix(neighbours)
+            neighbours.setdiag(0)
+            neighbours.eliminate_zeros()
+
+        self.ratings = matrix
+        self.neighbours = neighbours
+        self.cooccurrence = None
+        self.users = [str(user) for user in users]
+        self.items = [str(item) for item in items]
+
+    def _similarity(self, matrix):
+        """Cosine similarity between the rows of a sparse matrix, an entity is not its own neighbour."""
+        if self.lsh_tables is not None:
+            return _lsh_top_k_similarity(
+                matrix, self.k_neighbors, self.lsh_tables, self.lsh_bits, self.random_state)
+        if self.k_neighbors is not None:
+            return _top_k_similarity(matrix, self.k_neighbors)
+        return _sparse_similarity(matrix)
+
+    def _predictor(self):
+        """A function giving the predicted ratings of the given user rows, or of all users for None.
+
+        The normalized similarities and the user means are computed once here and shared by every call.
+        Neighbourhood models give a sparse matrix, als gives a dense array.
+        """
+        if self.rating_type == "item":
+            return partial(_predict_item, self.ratings, _item_weights(self.neighbours))
+        if self.rating_type == "user":
+            mean_user_rating, matrix_diff = _user_deviations(self.ratings)
+            return partial(_predict_user, _user_weights(self.neighbours), mean_user_rating, matrix_diff)
+        return partial(_predict_als, self.user_factors, self.item_factors)
+
+    def apply(self, df, options):
+        """Return the top_n unseen items of every known user in df, in long format."""
+        if self.user_field not in df:
+            raise RuntimeError('You must specify user field that exists. You sent %s' % self.user_field)
+
+        if self.neighbours is None and self.cooccurrence is not None:
+            self.neighbours = _cooccurrence_similarity(self.cooccurrence, self.k_neighbors)
+
+        rows = _lookup(self.users, df[self.user_field].dropna().astype(str).unique())
+        rows = rows[rows >= 0]
+
+        item_field = self.item_field or 'item'
+        rating_field = 'predicted_' + (self.rating_field or 'rating')
+
+        n_items = len(self.items)
+        top_n = min(self.top_n, n_items)
+        block_size = max(1, APPLY_CELLS // max(n_items, 1))
+        predict = self._predictor()
+        users, items, ratings, ranks = [[np.array([], dtype=int)] for _ in range(4)]
+        for start in range(0, len(rows) if top_n > 0 else 0, block_size):
+            block = rows[start:start + block_size]
+            top, scores = _top_n_unseen(predict(block), self.ratings[block], top_n)
+            found = np.isfinite(scores)
+
+            users.append(np.repeat(block, top_n)[found.ravel()])
+            items.append(top[found])
+            ratings.append(scores[found])
+            ranks.append(np.tile(np.arange(1, top_n + 1), len(block))[found.ravel()])
+
+        output_df = pd.DataFrame({
+            self.user_field: np.asarray(self.users, dtype=object)[np.concatenate(users)],
+            item_field: np.asarray(self.items, dtype=object)[np.concatenate(items)],
+            rating_field: np.concatenate(ratings),
+            'rank': np.concatenate(ranks),
+        })
+        return output_df[[self.user_field, item_field, rating_field, 'rank']]
+
+    @staticmethod
+    def register_codecs():
+        from codec.codecs import SimpleObjectCodec
+        codecs_manager.add_codec('algos_contrib.CollaborativeFilter', 'CollaborativeFilter', SimpleObjectCodec)
+        # scipy made the sparse modules private (csr -> _csr) in 1.8, register where the class lives
+        codecs_manager.add_codec(sp.csr_matrix.__module__, 'csr_matrix', SimpleObjectCodec)
+
+
+def _ratings_matrix(user_values, item_values, rating_values):
+    """Build a users x items CSR matrix from parallel arrays of events.
+
+    Repeated (user, item) events are summed and non-finite ratings are dropped.
+    Returns the matrix along with the user and item labels of its rows and columns.
+    """
+    try:
+        ratings = np.asarray(rating_values, dtype=np.float64)
+    except ValueError:
+        raise RuntimeError('Ratings must be numeric')
+
+    finite = np.isfinite(ratings)
+    user_codes, users = pd.factorize(np.asarray(user_values[finite]).astype(str))
+    item_codes, items = pd.factorize(np.asarray(item_values[finite]).astype(str))
+
+    matrix = sp.coo_matrix(
+        (ratings[finite], (user_codes, item_codes)),
+        shape=(len(users), len(items)),
+    ).tocsr()
+    matrix.eliminate_zeros()
+    return matrix, np.asarray(users), np.asarray(items)
+
+
+def _lookup(labels, values):
+    """Positions of values in labels, -1 for unknown values and the first position for repeated labels."""
+    positions = pd.Series(np.arange(len(labels)), index=labels)
+    positions = positions[~positions.index.duplicated()]
+    return positions.reindex(values).fillna(-1).values.astype(int)
+
+
+def _extend_labels(labels, new_labels):
+    """Positions of the distinct new_labels in labels, unknown labels are appended to labels."""
+    positions = _lookup(labels, new_labels)
+    unknown = positions < 0
+    positions[unknown] = len(labels) + np.arange(unknown.sum())
+    labels.extend(str(label) for label in new_labels[unknown])
+    return positions
+
+
+def _grow(matrix, shape):
+    """Pad a CSR matrix with empty rows and columns up to shape."""
+    extra_rows = shape[0] - matrix.shape[0]
+    indptr = np.concatenate([matrix.indptr, np.repeat(matrix.indptr[-1], extra_rows)])
+    return sp.csr_matrix((matrix.data, matrix.indices, indptr), shape=shape)
+
+
+def _sparse_similarity(matrix):
+    """Row by row cosine similarity of a sparse matrix, with the diagonal removed."""
+    sim = sp.csr_matrix(cosine_similarity(matrix, dense_output=False))
+    sim.setdiag(0)
+    sim.eliminate_zeros()
+    return sim
+
+
+def _top_k_similarity(matrix, k, block_size=None):
+    """Cosine similarity between rows keeping only each row's k most similar rows.
+
+    Similarities are computed block_size rows at a time, by default as many
+    rows as fit in SIMILARITY_CELLS, so memory does not grow with n x n.
+    """
+    normalized = normalize(matrix)
+    if block_size is None:
+        block_size = max(1, SIMILARITY_CELLS // max(normalized.shape[0], 1))
+    return _top_k_blocks(
+        lambda start, stop: normalized[start:stop].dot(normalized.T), normalized.shape[0], k, block_size)
+
+
+def _cooccurrence_similarity(cooccurrence, k=None):
+    """Cosine similarity from a co-occurrence (Gram) matrix, optionally keeping each row's top k."""
+    inverse_norms = _inverse(np.sqrt(cooccurrence.diagonal()))
+    sim = inverse_norms.dot(cooccurrence).dot(inverse_norms).tocsr()
+    sim.setdiag(0)
+    sim.eliminate_zeros()
+    if k is None:
+        return sim
+    return _top_k_rows(sim, k)
+
+
+def _lsh_top_k_similarity(matrix, k, n_tables, n_bits, random_state=None):
+    """Approximate top k cosine similarity between rows using random hyperplane signatures.
+
+    Each of the n_tables tables hashes every row to the signs of its
+    projections on n_bits random hyperplanes. Rows sharing a bucket in any
+    table are candidates, and only candidate pairs get an exact cosine.
+    Candidates are scored at most about LSH_PAIRS at a time and merged into
+    a running top k, so memory is bounded by n x k and the batch size rather
+    than by the squared bucket sizes.
+    """
+    normalized = sp.csr_matrix(normalize(matrix))
+    n = normalized.shape[0]
+    k = min(k, n - 1)
+    rng = np.random.RandomState(random_state)
+
+    # the hyperplanes have one row per column, that is one per user with rating_type=item,
+    # so they are drawn and projected on a slice of the columns at a time
+    by_column = normalized.tocsc()
+    projections = np.zeros((n, n_tables * n_bits))
+    step = max(1, LSH_PAIRS // (n_tables * n_bits))
+    for start in range(0, normalized.shape[1], step):
+        stop = min(start + step, normalized.shape[1])
+        projections += by_column[:, start:stop].dot(rng.normal(size=(stop - start, n_tables * n_bits)))
+    positive = projections > 0
+    powers = 2 ** np.arange(n_bits, dtype=np.int64)
+
+    # empty rows have no neighbours and would all share one bucket
+    nonempty = np.flatnonzero(np.diff(normalized.indptr))
+
+    top_cols = np.zeros((n, max(k, 0)), dtype=np.int64)
+    top_values = np.empty((n, max(k, 0)))
+    top_values.fill(-np.inf)
+    for table in range(n_tables if k > 0 else 0):
+        signatures = positive[nonempty, table * n_bits:(table + 1) * n_bits].dot(powers)
+        order, starts, sizes = _buckets(signatures)
+
+        # large buckets are scored block by block with one sparse product
+        dense = (sizes >= LSH_DENSE_BUCKET) | (sizes.astype(np.int64) ** 2 > LSH_PAIRS)
+        for start, size in zip(starts[dense], sizes[dense]):
+            members = nonempty[order[start:start + size]]
+            bucket = normalized[members]
+            step = max(1, LSH_PAIRS // size)
+            for first in range(0, size, step):
+                block = bucket[first:first + step].dot(bucket.T).toarray()
+                block[np.arange(len(block)), first + np.arange(len(block))] = 0
+                block[block == 0] = -np.inf
+                _merge_top_k_block(top_cols, top_values, members[first:first + step], members, block)
+
+        # small buckets are scored pair by pair, many buckets at a time
+        for left, right in _bucket_pair_batches(order, starts[~dense], sizes[~dense], LSH_PAIRS):
+            left, right = nonempty[left], nonempty[right]
+            products = normalized[left].multiply(normalized[right])
+            values = np.asarray(products.sum(axis=1)).ravel()
+            _merge_top_k(top_cols, top_values, left, right, values)
+
+    found = np.isfinite(top_values)
+    rows = np.repeat(np.arange(n), found.sum(axis=1))
+    return sp.coo_matrix((top_values[found], (rows, top_cols[found])), shape=(n, n)).tocsr()
+
+
+def _buckets(signatures):
+    """Positions sorted by signature, with the start and size of every bucket of at least 2 positions."""
+    order = np.argsort(signatures, kind='mergesort')
+    sorted_signatures = signatures[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(sorted_signatures)) + 1]).astype(np.int64)
+    sizes = np.diff(np.concatenate([starts, [len(order)]]))
+
+    # single rows have no pairs
+    paired = sizes > 1
+    return order, starts[paired], sizes[paired]
+
+
+def _bucket_pair_batches(order, starts, sizes, max_pairs):
+    """Batches of the ordered pairs (i, j), i != j, of positions sharing a bucket.
+
+    Buckets are grouped into batches of about max_pairs pairs, a batch holds
+    at most max_pairs pairs plus those of its last bucket.
+    """
+    n_pairs = sizes.astype(np.int64) ** 2
+    batch = (np.cumsum(n_pairs) - n_pairs) // max_pairs
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(batch)) + 1, [len(batch)]])
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        if last > first:
+            yield _pairs_within(order, starts[first:last], sizes[first:last])
+
+
+def _pairs_within(order, starts, sizes):
+    """All ordered pairs (i, j), i != j, of positions within the given buckets of the sorted order."""
+    # every position is paired with every position of its bucket
+    bucket_sizes = np.repeat(sizes, sizes)
+    bucket_starts = np.repeat(starts, sizes)
+    members = order[bucket_starts + np.arange(len(bucket_starts)) - np.repeat(np.cumsum(sizes) - sizes, sizes)]
+    left = np.repeat(members, bucket_sizes)
+    within = np.arange(len(left)) - np.repeat(np.cumsum(bucket_sizes) - bucket_sizes, bucket_sizes)
+    right = order[np.repeat(bucket_starts, bucket_sizes) + within]
+
+    distinct = left != right
+    return left[distinct], right[distinct]
+
+
+def _merge_top_k(top_cols, top_values, rows, cols, values):
+    """Merge candidate similarities into the running top k of every row, in place.
+
+    top_cols and top_values hold the k best columns of every row so far,
+    -inf marks an empty slot. Pairs already held are not counted twice and
+    zero similarities are not neighbours.
+    """
+    k = top_cols.shape[1]
+    touched = np.unique(rows)
+    held = np.isfinite(top_values[touched])
+    rows = np.concatenate([np.repeat(touched, held.sum(axis=1)), rows])
+    cols = np.concatenate([top_cols[touched][held], cols])
+    values = np.concatenate([top_values[touched][held], values])
+
+    # drop zeros and repeated (row, col) pairs, the held entry comes first
+    order = np.lexsort((cols, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    keep = np.concatenate([[True], (np.diff(rows) != 0) | (np.diff(cols) != 0)]) & (values != 0)
+    rows, cols, values = rows[keep], cols[keep], values[keep]
+
+    # sort by row, then by decreasing similarity, and keep the first k of each row
+    order = np.lexsort((-values, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    starts = np.searchsorted(rows, rows)
+    rank = np.arange(len(rows)) - starts
+    keep = rank < k
+
+    top_values[touched] = -np.inf
+    top_cols[rows[keep], rank[keep]] = cols[keep]
+    top_values[rows[keep], rank[keep]] = values[keep]
+
+
+def _merge_top_k_block(top_cols, top_values, rows, cols, values):
+    """Merge a dense block of similarities of rows to cols into the running top k of those rows, in place.
+
+    -inf in values marks a pair that is not a candidate. A column already
+    held by a row keeps its held entry.
+    """
+    k = top_cols.shape[1]
+    held_cols, held_values = top_cols[rows], top_values[rows]
+
+    order = np.argsort(cols)
+    position = order[np.minimum(np.searchsorted(cols, held_cols, sorter=order), len(cols) - 1)]
+    held = np.isfinite(held_values) & (cols[position] == held_cols)
+    values[np.nonzero(held)[0], position[held]] = -np.inf
+
+    values = np.hstack([held_values, values])
+    cols = np.hstack([held_cols, np.tile(cols, (len(rows), 1))])
+    top = np.argpartition(-values, k - 1, axis=1)[:, :k]
+    block_rows = np.arange(len(rows))[:, np.newaxis]
+    top_cols[rows] = cols[block_rows, top]
+    top_values[rows] = values[block_rows, top]
+
+
+def _top_k_rows(sim, k):
+    """Keep the k largest off-diagonal entries of every row of a sparse similarity matrix."""
+    sim = sim.tocoo()
+    keep = (sim.row != sim.col) & (sim.data != 0)
+    rows, cols, values = sim.row[keep], sim.col[keep], sim.data[keep]
+
+    # sort by row, then by decreasing similarity, and keep the first k of each row
+    order = np.lexsort((-values, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    counts = np.bincount(rows, minlength=sim.shape[0])
+    rank = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    keep = rank < k
+
+    return sp.coo_matrix((values[keep], (rows[keep], cols[keep])), shape=sim.shape).tocsr()
+
+
+def _top_k_blocks(similarity_block, n, k, block_size):
+    """Keep the k largest off-diagonal similarities of every row, block_size rows at a time.
+
+    similarity_block(start, stop) returns the similarities of rows start:stop
+    to all n rows, dense or sparse.
+    """
+    k = min(k, n - 1)
+    if k <= 0:
+        return sp.csr_matrix((n, n))
+
+    rows, cols, values = [], [], []
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block_rows = np.arange(stop - start)
+
+        block = similarity_block(start, stop)
+        block = block.toarray() if sp.issparse(block) else np.array(block)
+        block[block_rows, block_rows + start] = -np.inf
+
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        top_values = block[block_rows[:, np.newaxis], top]
+        keep = np.isfinite(top_values) & (top_values != 0)
+
+        rows.append(np.repeat(block_rows + start, k)[keep.ravel()])
+        cols.append(top[keep])
+        values.append(top_values[keep])
+
+    return sp.coo_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n, n),
+    ).tocsr()
+
+
+def _inverse(weights):
+    """Elementwise 1/weights as a sparse diagonal matrix, treating 1/0 as 0."""
+    with np.errstate(divide='ignore'):
+        inverse = 1.0 / weights
+    inverse[~np.isfinite(inverse)] = 0.0
+    return sp.diags(inverse, 0)
+
+
+def _item_weights(item_sim):
+    """Item similarity with every column divided by its sum of absolute similarities."""
+    norm = np.asarray(abs(item_sim).sum(axis=0)).ravel()
+    return sp.csr_matrix(item_sim.dot(_inverse(norm)))
+
+
+def _user_weights(user_sim):
+    """User similarity with every row divided by its sum of absolute similarities."""
+    norm = np.asarray(abs(user_sim).sum(axis=1)).ravel()
+    return sp.csr_matrix(_inverse(norm).dot(user_sim))
+
+
+def _user_deviations(matrix):
+    """Mean observed rating of every user and the sparse deviations of the observed ratings from it."""
+    counts = np.diff(matrix.indptr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_user_rating = np.asarray(matrix.sum(axis=1)).ravel() / counts
+    mean_user_rating[counts == 0] = 0.0
+
+    matrix_diff = matrix.copy()
+    matrix_diff.data -= np.repeat(mean_user_rating, counts)
+    return mean_user_rating, matrix_diff
+
+
+def _predict_item(matrix, item_weights, rows=None):
+    """Item based predictions: ratings weighted by the normalized item similarity."""
+    if rows is not None:
+        matrix = matrix[rows]
+    return matrix.dot(item_weights).tocsr()
+
+
+def _predict_user(user_weights, mean_user_rating, matrix_diff, rows=None):
+    """User based predictions: mean user rating plus similarity weighted deviations.
+
+    Means and deviations only use the observed ratings so the matrix stays sparse.
+    """
+    if rows is not None:
+        user_weights = user_weights[rows]
+        mean_user_rating = mean_user_rating[rows]
+
+    predicted = user_weights.dot(matrix_diff).tocsr()
+    predicted.data += np.repeat(mean_user_rating, np.diff(predicted.indptr))
+    return predicted
+
+
+def _predict_als(user_factors, item_factors, rows=None):
+    """Als predictions: products of the user and item factors."""
+    if rows is not None:
+        user_factors = user_factors[rows]
+    return user_factors.dot(item_factors.T)
+
+
+def _top_n_unseen(predicted, seen, n):
+    """Column indices and scores of the n best predicted, unseen items of every row.
+
+    Rows run out of candidates when fewer than n items are reachable, the
+    missing slots are reported with a score of -inf.
+    """
+    if sp.issparse(predicted):
+        scores = np.empty(predicted.shape)
+        scores.fill(-np.inf)
+        predicted = predicted.tocoo()
+        scores[predicted.row, predicted.col] = predicted.data
+    else:
+        scores = np.array(predicted, dtype=np.float64)
+    seen = seen.tocoo()
+    scores[seen.row, seen.col] = -np.inf
+
+    if n < scores.shape[1]:
+        top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    else:
+        top = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    rows = np.arange(scores.shape[0])[:, np.newaxis]
+    order = np.argsort(-scores[rows, top], axis=1, kind='mergesort')
+    top = top[rows, order]
+    return top, scores[rows, top]
+
+
+def _als(matrix, factors, regularization, iterations, n_jobs=1, random_state=None):
+    """Alternating least squares over the observed entries of a sparse users x items matrix.
+
+    Each half step solves the regularized least squares problem of every
+    user (then every item) with the other side held fixed, with the
+    regularization scaled by the number of ratings of the row (ALS-WR).
+    Returns the user factors and the item factors.
+    """
+    rng = np.random.RandomState(random_state)
+    item_factors = rng.normal(0, 1.0 / np.sqrt(factors), (matrix.shape[1], factors))
+    by_item = matrix.T.tocsr()
+
+    # numpy releases the GIL in the batched products and solves, so threads are enough
+    pool = ThreadPool(n_jobs) if n_jobs > 1 else None
+    try:
+        for _ in range(iterations):
+            user_factors = _als_half_step(matrix, item_factors, regularization, pool, n_jobs)
+            item_factors = _als_half_step(by_item, user_factors, regularization, pool, n_jobs)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return user_factors, item_factors
+
+
+def _als_half_step(ratings, fixed, regularization, pool=None, n_jobs=1):
+    """Solve for the factors of every row of a CSR ratings matrix, batch by batch."""
+    n_factors = fixed.shape[1]
+    max_entries = max(1, min(ALS_CELLS // (n_factors * n_factors), ratings.nnz // n_jobs + 1))
+
+    batches = _row_batches(ratings.indptr, max_entries)
+    solve = partial(_als_solve, ratings, fixed, regularization)
+    solved = pool.map(solve, batches) if pool is not None else [solve(batch) for batch in batches]
+    return np.vstack(solved)
+
+
+def _row_batches(indptr, max_entries):
+    """Split the rows of a CSR matrix into (start, stop) batches of at most max_entries entries."""
+    n_rows = len(indptr) - 1
+    bounds = [0]
+    while bounds[-1] < n_rows:
+        start = bounds[-1]
+        stop = int(np.searchsorted(indptr, indptr[start] + max_entries, side='right')) - 1
+        bounds.append(min(n_rows, max(stop, start + 1)))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _als_solve(ratings, fixed, regularization, batch):
+    """Vectorized least squares solves for the rows start:stop of a CSR ratings matrix."""
+    start, stop = batch
+    n_factors = fixed.shape[1]
+    begin, end = ratings.indptr[start], ratings.indptr[stop]
+    counts = np.diff(ratings.indptr[start:stop + 1])
+    rated = counts > 0
+
+    # one factors x factors normal equation per row, rows without ratings get a zero solution
+    gram = np.empty((stop - start, n_factors, n_factors))
+    gram[:] = np.eye(n_factors)
+    rhs = np.zeros((stop - start, n_factors))
+    if (end - begin) * n_factors * n_factors <= ALS_CELLS:
+        selected = fixed[ratings.indices[begin:end]]
+        values = ratings.data[begin:end]
+        if end > begin:
+            offsets = (ratings.indptr[start:stop] - begin)[rated]
+            gram[rated] = np.add.reduceat(selected[:, :, np.newaxis] * selected[:, np.newaxis, :], offsets, axis=0)
+            rhs[rated] = np.add.reduceat(selected * values[:, np.newaxis], offsets, axis=0)
+    else:
+        # a row with more ratings than the batch budget, as popular items have, accumulates its
+        # normal equation over slices of its ratings instead of holding one outer product per rating
+        gram[rated] = 0.0
+        step = max(1, ALS_CELLS // n_factors)
+        for row in np.flatnonzero(rated):
+            for first in range(ratings.indptr[start + row], ratings.indptr[start + row + 1], step):
+                last = min(first + step, ratings.indptr[start + row + 1])
+                selected = fixed[ratings.indices[first:last]]
+                gram[row] += selected.T.dot(selected)
+                rhs[row] += ratings.data[first:last].dot(selected)
+    gram[rated] += regularization * counts[rated, np.newaxis, np.newaxis] * np.eye(n_factors)
 
+    return np.linalg.solve(gram, rhs[:, :, np.newaxis])[:, :, 0]
@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 
+import base64
+import ctypes
+import zlib
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+
 from sklearn.ensemble import IsolationForest as _IsolationForest
+from sklearn.ensemble.iforest import _average_path_length
 import numpy as np
 import pandas as pd
 
@@ -12,6 +19,13 @@ from util import df_util
 from util.param_util import convert_params
 from cexc import get_messages_logger,get_logger
 
+# number of (row, tree) pairs traversed at once when scoring, small enough to stay in cache
+SCORE_CELLS = 2 ** 16
+
+# rows below which apply scores in the search process, a process pool does not pay off
+PARALLEL_ROWS = 2 ** 16
+
+
 class IsolationForest(ClustererMixin, BaseAlgo):
     """
     This is the implementation wrapper around Isolation Forest from scikit-learn. It inherits methods from ClustererMixin and BaseAlgo.
@@ -20,11 +34,20 @@ class IsolationForest(ClustererMixin, BaseAlgo):
         self.handle_options(options)
         out_params = convert_params(
             options.get('params',{}),
-            ints = ['n_estimators','n_jobs','random_state','verbose'],
+            ints = ['n_estimators','n_jobs','random_state','verbose','replace_trees'],
             floats = ['max_samples','contamination','max_features'],
-            bools = ['bootstrap']
+            bools = ['bootstrap','anomaly_score','float32_thresholds']
             )
-        self.return_scores = out_params.pop('anomaly_score', True)
+        # anomaly_score=true adds the score of every row next to isOutlier, the output is unchanged by default
+        self.return_scores = out_params.pop('anomaly_score', False)
+        self.replace_trees = out_params.pop('replace_trees', None)
+        self.float32_thresholds = out_params.pop('float32_thresholds', False)
+        self.n_updates = 0
+
+        # whitelist replace_trees > 0
+        if self.replace_trees is not None and self.replace_trees <= 0:
+            msg = 'Invalid value error: replace_trees must be greater than 0 and an integer, but found replace_trees="{}".'
+            raise RuntimeError(msg.format(self.replace_trees))
 
         # whitelist n_estimators > 0
         if 'n_estimators' in out_params and out_params['n_estimators']<=0:
@@ -52,6 +75,56 @@ class IsolationForest(ClustererMixin, BaseAlgo):
         
         self.estimator = _IsolationForest(**out_params)    
 
+    def fit(self, df, options):
+        # Make a copy of data, to not alter original dataframe
+        X = df.copy()
+
+        X, _, self.columns = df_util.prepare_features(
+            X=X,
+            variables=self.feature_variables,
+            mlspl_limits=options.get('mlspl_limits'),
+        )
+        self.estimator.fit(X.values)
+
+        # The compiled forest is the saved model, the estimator only keeps its parameters
+        self.forest = self.compile_forest(self.estimator, X.shape[1])
+        self.estimator = _IsolationForest(**self.estimator.get_params())
+
+    def partial_fit(self, df, options):
+        """Replace the oldest trees of the forest with trees grown on the new chunk."""
+        if getattr(self, 'forest', None) is None:
+            return self.fit(df, options)
+
+        # Make a copy of data, to not alter original dataframe
+        X = df.copy()
+
+        X, _, _ = df_util.prepare_features(
+            X=X,
+            variables=self.feature_variables,
+            final_columns=self.columns,
+            mlspl_limits=options.get('mlspl_limits'),
+        )
+        if X.empty:
+            return
+
+        # By default a tenth of the forest is regrown on every update
+        n_trees = len(self.forest.roots)
+        params = self.estimator.get_params()
+        params['n_estimators'] = min(n_trees, self.replace_trees or max(1, n_trees // 10))
+        self.n_updates = getattr(self, 'n_updates', 0) + 1
+        if params.get('random_state') is not None:
+            params['random_state'] += self.n_updates
+
+        estimator = _IsolationForest(**params).fit(X.values)
+        self.forest = self.forest.replace_oldest(self.compile_forest(estimator, X.shape[1]))
+
+        # The threshold follows the newest chunk
+        contamination = params.get('contamination')
+        if contamination == 'auto':
+            self.forest.score_threshold = 0.5
+        else:
+            scores = self.forest.scores(X.values)
+            self.forest.score_threshold = float(np.percentile(scores, 100.0 * (1.0 - contamination)))
 
     def apply(self, df, options):
         # Make a copy of data, to not alter original dataframe
@@ -65,13 +138,20 @@ class IsolationForest(ClustererMixin, BaseAlgo):
             mlspl_limits=options.get('mlspl_limits'),
         )
 
-        # Multiplying the result by -1 to represent Outliers with 1 and Inliers/Normal points with 1.
-        y_hat = self.estimator.predict(X.values)*-1
+        # Models saved before the forest was compiled still carry the fitted estimator
+        if getattr(self, 'forest', None) is None:
+            self.forest = self.compile_forest(self.estimator, X.shape[1])
+
+        # One traversal of the forest gives both the anomaly score and the label.
+        # Representing Outliers with 1 and Inliers/Normal points with -1.
+        n_jobs = self.estimator.get_params().get('n_jobs') or 1
+        if n_jobs < 0:
+            n_jobs = max(1, cpu_count() + 1 + n_jobs)
+        scores = self.forest.scores(X.values, n_jobs=n_jobs)
+        y_hat = np.where(scores >= self.forest.score_threshold, 1, -1).astype(np.int8)
         # Printing the accuracy for prediction of outliers
-        accuracy = "Accuracy: {}".format(str(round((list(y_hat).count(-1)*100)/y_hat.shape[0], 2)))
+        accuracy = "Accuracy: {}".format(str(round((np.count_nonzero(y_hat == -1)*100.0)/y_hat.shape[0], 2)))
         logger.debug(accuracy)
-        
-        y_hat = y_hat.astype('str')
 
         #Assign output_name
         default_name = 'isOutlier'
@@ -84,8 +164,20 @@ class IsolationForest(ClustererMixin, BaseAlgo):
         )
         # Merge with original dataframe
         output = df_util.merge_predictions(df, output)
+
+        if self.return_scores:
+            scores = df_util.create_output_dataframe(
+                y_hat=scores, nans=nans, output_names='anomaly_score'
+            )
+            output = df_util.merge_predictions(output, scores)
         return output
 
+    def compile_forest(self, estimator, n_features):
+        """Compile a fitted scikit-learn forest, carrying over how its thresholds are saved."""
+        forest = CompiledForest.from_estimator(estimator, n_features)
+        forest.float32_thresholds = getattr(self, 'float32_thresholds', False)
+        return forest
+
     def rename_output(self, default_names, new_names=None):
         """Utility hook to rename output.
 
@@ -100,11 +192,201 @@ class IsolationForest(ClustererMixin, BaseAlgo):
     def register_codecs():
         from codec.codecs import SimpleObjectCodec, TreeCodec
         codecs_manager.add_codec('algos.IsolationForest', 'IsolationForest', SimpleObjectCodec)
+        codecs_manager.add_codec('algos_contrib.IsolationForest', 'IsolationForest', SimpleObjectCodec)
+        codecs_manager.add_codec('algos_contrib.IsolationForest', 'CompiledForest', CompiledForestCodec)
         codecs_manager.add_codec('sklearn.ensemble.iforest', 'IsolationForest', SimpleObjectCodec)
         codecs_manager.add_codec('sklearn.tree.tree','ExtraTreeRegressor', ExtraTreeRegressorCodec)
         codecs_manager.add_codec('sklearn.tree._tree', 'Tree', TreeCodec)
 
 
+class CompiledForest(object):
+    """
+    A fitted isolation forest flattened into contiguous node arrays, so that all rows and all trees are scored
+    together one tree level at a time.
+
+    Node i of the ensemble splits on feature[i] at threshold[i] into left[i] and right[i]. Leaves point to
+    themselves and store their path length (depth plus the average path length of the training samples left in
+    the leaf) in path_length[i]. Tree t starts at node roots[t].
+    """
+    # whether CompiledForestCodec saves the thresholds as float32
+    float32_thresholds = False
+
+    def __init__(self, feature, threshold, left, right, path_length, roots, depth, normalizer, score_threshold):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.path_length = path_length
+        self.roots = roots
+        self.depth = depth
+        self.normalizer = normalizer
+        self.score_threshold = score_threshold
+
+    @classmethod
+    def from_estimator(cls, estimator, n_features):
+        # Like scikit-learn, trees only see their own feature subset when features were subsampled
+        subsample_features = getattr(estimator, '_max_features', n_features) != n_features
+
+        features, thresholds, lefts, rights, path_lengths, roots = [], [], [], [], [], []
+        offset = max_depth = 0
+        for tree, tree_features in zip(estimator.estimators_, estimator.estimators_features_):
+            tree_ = tree.tree_
+            n_nodes = tree_.node_count
+            nodes = np.arange(n_nodes)
+            is_leaf = tree_.children_left == -1
+
+            # nodes are numbered in creation order, so parents come before their children
+            depth = np.zeros(n_nodes, dtype=np.int32)
+            for node in np.flatnonzero(~is_leaf):
+                depth[tree_.children_left[node]] = depth[tree_.children_right[node]] = depth[node] + 1
+
+            feature = np.maximum(tree_.feature, 0)
+            if subsample_features:
+                feature = np.asarray(tree_features)[feature]
+
+            features.append(np.where(is_leaf, 0, feature))
+            thresholds.append(tree_.threshold)
+            lefts.append(np.where(is_leaf, nodes, tree_.children_left) + offset)
+            rights.append(np.where(is_leaf, nodes, tree_.children_right) + offset)
+            path_lengths.append(np.where(is_leaf, depth + _average_path_length(tree_.n_node_samples), 0.0))
+            roots.append(offset)
+            offset += n_nodes
+            max_depth = max(max_depth, int(depth.max()))
+
+        normalizer = _average_path_length(np.array([estimator.max_samples_]))[0]
+
+        # scikit-learn flags scores 2 ** (-path length / normalizer) at or above its fitted threshold
+        if hasattr(estimator, 'threshold_'):
+            score_threshold = 0.5 - estimator.threshold_
+        else:
+            score_threshold = -estimator.offset_
+
+        return cls(
+            feature=np.concatenate(features).astype(np.int32),
+            threshold=np.concatenate(thresholds).astype(np.float64),
+            left=np.concatenate(lefts).astype(np.int32),
+            right=np.concatenate(rights).astype(np.int32),
+            path_length=np.concatenate(path_lengths).astype(np.float64),
+            roots=np.array(roots, dtype=np.int32),
+            depth=max_depth,
+            normalizer=float(normalizer),
+            score_threshold=float(score_threshold),
+        )
+
+    def replace_oldest(self, newer):
+        """A forest without the oldest trees of this one, followed by the trees of newer.
+
+        Trees grown on chunks of a different size have a different average path length c(max_samples), so the
+        kept path lengths are rescaled to keep every tree normalized by its own c(max_samples) under the
+        normalizer of newer.
+        """
+        n_kept = max(0, len(self.roots) - len(newer.roots))
+        cut = self.roots[len(self.roots) - n_kept] if n_kept else len(self.feature)
+        offset = len(self.feature) - cut
+        scale = newer.normalizer / self.normalizer
+
+        def join(kept, added):
+            return np.concatenate([kept[cut:], added])
+
+        forest = CompiledForest(
+            feature=join(self.feature, newer.feature),
+            threshold=join(self.threshold, newer.threshold),
+            left=np.concatenate([self.left[cut:] - cut, newer.left + offset]).astype(np.int32),
+            right=np.concatenate([self.right[cut:] - cut, newer.right + offset]).astype(np.int32),
+            path_length=join(self.path_length * scale, newer.path_length),
+            roots=np.concatenate([self.roots[len(self.roots) - n_kept:] - cut, newer.roots + offset]).astype(np.int32),
+            depth=max(self.depth, newer.depth),
+            normalizer=newer.normalizer,
+            score_threshold=newer.score_threshold,
+        )
+        forest.float32_thresholds = newer.float32_thresholds
+        return forest
+
+    def path_lengths(self, X):
+        """Average path length of every row of X over the trees of the forest."""
+        # Trees compare float32 features with float64 thresholds
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_rows, n_features = X.shape
+        feature = self.feature.astype(np.intp)
+        children = np.column_stack([self.right, self.left]).astype(np.intp)
+        roots = self.roots.astype(np.intp)
+
+        lengths = np.empty(n_rows)
+        block_size = max(1, SCORE_CELLS // len(roots))
+        for start in range(0, n_rows, block_size):
+            values = X[start:start + block_size].ravel()
+            row_offsets = (np.arange(len(values) // n_features) * n_features)[:, np.newaxis]
+            nodes = np.tile(roots, (len(row_offsets), 1))
+            for _ in range(self.depth):
+                go_left = values[row_offsets + feature[nodes]] <= self.threshold[nodes]
+                nodes = children[nodes, go_left.view(np.int8)]
+            lengths[start:start + block_size] = self.path_length[nodes].mean(axis=1)
+        return lengths
+
+    def scores(self, X, n_jobs=1):
+        """Anomaly scores in (0, 1], the higher the more anomalous.
+
+        With n_jobs > 1, large inputs are scored in a pool of worker processes.
+        """
+        if n_jobs > 1 and len(X) >= PARALLEL_ROWS:
+            lengths = parallel_path_lengths(self, X, n_jobs)
+        else:
+            lengths = self.path_lengths(X)
+        return 2 ** (-lengths / self.normalizer)
+
+    def is_outlier(self, X):
+        """Whether each row of X is an outlier."""
+        return self.scores(X) >= self.score_threshold
+
+
+# Parallel scoring: the forest and the rows are copied once into shared memory, which the workers read without
+# copying, and every worker scores a contiguous range of rows.
+_FOREST_ARRAYS = ('feature', 'threshold', 'left', 'right', 'path_length', 'roots')
+_FOREST_SCALARS = ('depth', 'normalizer', 'score_threshold')
+_worker = {}
+
+
+def _to_shared(array):
+    array = np.ascontiguousarray(array)
+    buf = RawArray(ctypes.c_byte, max(array.nbytes, 1))
+    np.frombuffer(buf, dtype=array.dtype, count=array.size).reshape(array.shape)[...] = array
+    return buf, array.dtype.str, array.shape
+
+
+def _from_shared(shared):
+    buf, dtype, shape = shared
+    return np.frombuffer(buf, dtype=np.dtype(dtype), count=int(np.prod(shape))).reshape(shape)
+
+
+def _init_worker(shared_forest, scalars, shared_X):
+    arrays = dict((name, _from_shared(shared)) for name, shared in shared_forest.items())
+    arrays.update(scalars)
+    _worker['forest'] = CompiledForest(**arrays)
+    _worker['X'] = _from_shared(shared_X)
+
+
+def _worker_path_lengths(bounds):
+    start, stop = bounds
+    return _worker['forest'].path_lengths(_worker['X'][start:stop])
+
+
+def parallel_path_lengths(forest, X, n_jobs):
+    """Average path lengths of the rows of X, scored in n_jobs worker processes."""
+    shared_forest = dict((name, _to_shared(getattr(forest, name))) for name in _FOREST_ARRAYS)
+    scalars = dict((name, getattr(forest, name)) for name in _FOREST_SCALARS)
+    shared_X = _to_shared(np.asarray(X, dtype=np.float32))
+
+    # a few chunks per worker keeps the workers busy when chunks run at different speeds
+    bounds = np.linspace(0, len(X), 4 * n_jobs + 1).astype(int)
+    pool = Pool(n_jobs, initializer=_init_worker, initargs=(shared_forest, scalars, shared_X))
+    try:
+        lengths = pool.map(_worker_path_lengths, list(zip(bounds[:-1], bounds[1:])))
+    finally:
+        pool.close()
+        pool.join()
+    return np.concatenate(lengths)
+
+
 class ExtraTreeRegressorCodec(BaseCodec):
     """
     This is an ExtraTreeRegressor Codec for saving the Isolation Forest base estimator to memory/file.
@@ -113,16 +395,116 @@ class ExtraTreeRegressorCodec(BaseCodec):
     def encode(cls, obj):
         import sklearn.tree
         assert type(obj) == sklearn.tree.tree.ExtraTreeRegressor
-        state = obj.__getstate__()
+        state = obj.__getstate__().copy()
+
+        # The tree nodes and values are saved as packed binary arrays instead of nested lists
+        tree_cls, (n_features, n_classes, n_outputs), tree_state = state.pop('tree_').__reduce__()
+        tree = {
+            'n_features': int(n_features),
+            'n_classes': pack_array(n_classes),
+            'n_outputs': int(n_outputs),
+            'state': dict(
+                (key, pack_array(value) if isinstance(value, np.ndarray) else value)
+                for key, value in tree_state.items()
+            ),
+        }
         return {
             '__mlspl_type': [type(obj).__module__, type(obj).__name__],
-            'state': state
+            'state': state,
+            'tree': tree,
         }
 
     @classmethod
     def decode(cls,obj):
         from sklearn.tree.tree import ExtraTreeRegressor
+        from sklearn.tree._tree import Tree
         state = obj['state']
+        # Models saved before the packed encoding keep the tree inside the state
+        if 'tree' in obj:
+            tree = obj['tree']
+            tree_state = dict(
+                (str(key), unpack_array(value) if is_packed(value) else value)
+                for key, value in tree['state'].items()
+            )
+            state['tree_'] = Tree(tree['n_features'], unpack_array(tree['n_classes']), tree['n_outputs'])
+            state['tree_'].__setstate__(tree_state)
         t = ExtraTreeRegressor.__new__(ExtraTreeRegressor)
         t.__setstate__(state)
-        return t
\ No newline at end of file
+        return t
+
+
+class CompiledForestCodec(BaseCodec):
+    """
+    Saves a CompiledForest as packed, compressed node arrays. With float32_thresholds the thresholds are rounded
+    down to float32, which keeps every split decision since the features are compared as float32.
+    """
+    @classmethod
+    def encode(cls, obj):
+        assert type(obj) == CompiledForest
+        arrays = dict((name, getattr(obj, name)) for name in _FOREST_ARRAYS)
+        if obj.float32_thresholds:
+            arrays['threshold'] = float32_floor(obj.threshold)
+        return {
+            '__mlspl_type': [type(obj).__module__, type(obj).__name__],
+            'arrays': dict((name, pack_array(array)) for name, array in arrays.items()),
+            'scalars': dict((name, getattr(obj, name)) for name in _FOREST_SCALARS),
+            'float32_thresholds': obj.float32_thresholds,
+        }
+
+    @classmethod
+    def decode(cls, obj):
+        kwargs = dict((str(name), unpack_array(packed)) for name, packed in obj['arrays'].items())
+        kwargs['threshold'] = kwargs['threshold'].astype(np.float64)
+        kwargs.update((str(name), value) for name, value in obj['scalars'].items())
+        forest = CompiledForest(**kwargs)
+        forest.float32_thresholds = obj['float32_thresholds']
+        return forest
+
+
+def pack_array(array):
+    """A JSON friendly dict holding the zlib compressed, base64 encoded bytes of an array with its dtype and shape."""
+    array = np.ascontiguousarray(array)
+    dtype = array.dtype.str
+    if array.dtype.fields:
+        # structured arrays keep their exact layout, padding included
+        names = list(array.dtype.names)
+        dtype = {
+            'names': names,
+            'formats': [array.dtype.fields[name][0].str for name in names],
+            'offsets': [array.dtype.fields[name][1] for name in names],
+            'itemsize': array.dtype.itemsize,
+        }
+    return {
+        '__packed': True,
+        'dtype': dtype,
+        'shape': list(array.shape),
+        'data': base64.b64encode(zlib.compress(array.tobytes())).decode('ascii'),
+    }
+
+
+def is_packed(value):
+    return isinstance(value, dict) and value.get('__packed', False)
+
+
+def unpack_array(packed):
+    """The writable array stored by pack_array."""
+    dtype = packed['dtype']
+    if isinstance(dtype, dict):
+        dtype = {
+            'names': [str(name) for name in dtype['names']],
+            'formats': [str(fmt) for fmt in dtype['formats']],
+            'offsets': dtype['offsets'],
+            'itemsize': dtype['itemsize'],
+        }
+    else:
+        dtype = str(dtype)
+    data = zlib.decompress(base64.b64decode(packed['data']))
+    return np.frombuffer(data, dtype=np.dtype(dtype)).reshape(packed['shape']).copy()
+
+
+def float32_floor(values):
+    """The largest float32 values not above values, so that x <= floor holds exactly when x <= values for float32 x."""
+    rounded = values.astype(np.float32)
+    above = rounded.astype(np.float64) > values
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
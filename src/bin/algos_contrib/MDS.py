@@ -1,6 +1,13 @@
 #!/usr/bin/env python
 
+import ctypes
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
 from sklearn.manifold import MDS as _MDS
+from sklearn.manifold import smacof
+from sklearn.metrics import euclidean_distances
 
 from base import BaseAlgo, TransformerMixin
 from codec import codecs_manager
@@ -8,18 +15,38 @@ from util.param_util import convert_params
 
 from util import df_util
 
+# Number of distances computed at once
+DISTANCE_CELLS = 2 ** 22
+
+# Only the dissimilarities are shared between restarts: every SMACOF run still allocates its own n x n float64
+# temporaries, measured at about 6 of them with metric=true and 11 with metric=false, so peak memory grows with
+# the number of parallel runs. Workers are capped so that their temporaries stay below SMACOF_CELLS in total.
+SMACOF_CELLS = 2 ** 28
+SMACOF_TEMPORARIES = {True: 6, False: 11}
+
+
 class MDS(TransformerMixin, BaseAlgo):
 
     def __init__(self, options):
         self.handle_options(options)
         out_params = convert_params(
             options.get('params', {}),
-            ints=['k', 'max_iter', 'n_init', 'n_jobs'],
+            ints=['k', 'max_iter', 'n_init', 'n_jobs', 'landmarks', 'random_state'],
             floats=['eps'],
             bools=['metric'],
             aliases={'k': 'n_components'}
         )
 
+        # Landmark MDS: classical MDS on a random sample of landmarks, every point
+        # (including new ones in apply) is then placed by triangulation against them
+        self.landmarks = out_params.pop('landmarks', None)
+        if self.landmarks is not None:
+            if self.landmarks < out_params.get('n_components', 2) + 1:
+                msg = 'Invalid value for landmarks: landmarks must be greater than k, but found landmarks="{}".'
+                raise RuntimeError(msg.format(self.landmarks))
+            if not out_params.get('metric', True):
+                raise RuntimeError('landmarks can not be used with metric=false')
+
         if 'max_iter' not in out_params:
             out_params.setdefault('max_iter', 300)
 
@@ -43,6 +70,48 @@ class MDS(TransformerMixin, BaseAlgo):
         output_names = ['{}_{}'.format(new_names, i+1) for i in xrange(len(default_names))]
         return output_names
 
+    def fit(self, df, options):
+        # Make a copy of data, to not alter original dataframe
+        X = df.copy()
+
+        X, nans, self.columns = df_util.prepare_features(
+            X=X,
+            variables=self.feature_variables,
+            mlspl_limits=options.get('mlspl_limits'),
+        )
+        X = X.values.astype(np.float64)
+
+        if self.landmarks is None:
+            return self.make_output(df, self.restarts(X), nans, options)
+
+        rng = np.random.RandomState(self.estimator.random_state)
+        landmarks = np.sort(rng.choice(len(X), min(self.landmarks, len(X)), replace=False))
+        self.landmark_points = X[landmarks]
+
+        # Classical MDS of the landmarks: top eigenvectors of the double centered squared distances
+        squared = euclidean_distances(self.landmark_points, squared=True)
+        centered = squared - squared.mean(axis=0) - squared.mean(axis=1)[:, np.newaxis] + squared.mean()
+        eigenvalues, eigenvectors = np.linalg.eigh(-0.5 * centered)
+        top = np.argsort(eigenvalues)[::-1][:self.estimator.n_components]
+        eigenvalues, eigenvectors = eigenvalues[top], eigenvectors[:, top]
+
+        # Directions without positive variance get coordinate 0
+        positive = eigenvalues > 0
+        self.landmark_pinv = np.zeros(eigenvectors.T.shape)
+        self.landmark_pinv[positive] = eigenvectors[:, positive].T / np.sqrt(eigenvalues[positive])[:, np.newaxis]
+        self.landmark_mean = squared.mean(axis=1)
+
+        return self.make_output(df, self.triangulate(X), nans, options)
+
+    def triangulate(self, X):
+        """Coordinates of the rows of X from their squared distances to the landmarks."""
+        y_hat = np.empty((len(X), len(self.landmark_pinv)))
+        step = max(1, DISTANCE_CELLS // len(self.landmark_points))
+        for start in range(0, len(X), step):
+            squared = euclidean_distances(X[start:start + step], self.landmark_points, squared=True)
+            y_hat[start:start + step] = -0.5 * (squared - self.landmark_mean).dot(self.landmark_pinv.T)
+        return y_hat
+
     def apply(self, df, options):
         # Make a copy of data, to not alter original dataframe
         X = df.copy()
@@ -54,9 +123,53 @@ class MDS(TransformerMixin, BaseAlgo):
             final_columns=self.columns,
         )
 
-        # Call the transform method
-        y_hat = self.estimator.fit_transform(X.values)
+        if getattr(self, 'landmark_points', None) is not None:
+            y_hat = self.triangulate(X.values.astype(np.float64))
+        else:
+            y_hat = self.restarts(X.values.astype(np.float64))
+
+        return self.make_output(df, y_hat, nans, options)
+
+    def restarts(self, X):
+        """Best of n_init SMACOF runs, all reading one dissimilarity matrix in shared memory.
+
+        Each run gets its own seed drawn from random_state, so the result does not depend on n_jobs.
+        """
+        params = self.estimator.get_params()
+        n_init, n_jobs = params['n_init'], params['n_jobs'] or 1
+        if n_jobs < 0:
+            n_jobs = max(1, cpu_count() + 1 + n_jobs)
+        n_jobs = min(n_jobs, n_init, max_smacof_jobs(len(X), params['metric']))
+
+        rng = np.random.RandomState(params['random_state'])
+        seeds = rng.randint(np.iinfo(np.int32).max, size=n_init)
+        smacof_params = dict(
+            metric=params['metric'],
+            n_components=params['n_components'],
+            max_iter=params['max_iter'],
+            eps=params['eps'],
+            verbose=params['verbose'],
+        )
 
+        shared = shared_dissimilarities(X)
+        if n_jobs > 1:
+            pool = Pool(n_jobs, initializer=_init_worker, initargs=(shared, len(X), smacof_params))
+            try:
+                runs = pool.map(_worker_smacof, seeds)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_worker(shared, len(X), smacof_params)
+            try:
+                runs = [_worker_smacof(seed) for seed in seeds]
+            finally:
+                _worker.clear()
+
+        embeddings, stresses = zip(*runs)
+        return embeddings[int(np.argmin(stresses))]
+
+    def make_output(self, df, y_hat, nans, options):
         # Assign output_name
         output_name = options.get('output_name', None)
         default_names = self.make_output_names(
@@ -80,4 +193,37 @@ class MDS(TransformerMixin, BaseAlgo):
     def register_codecs():
         from codec.codecs import SimpleObjectCodec
         codecs_manager.add_codec('algos_contrib.MDS', 'MDS', SimpleObjectCodec)
-        codecs_manager.add_codec('sklearn.manifold.MDS', 'MDS', SimpleObjectCodec)
+        # The sklearn module was made private (mds -> _mds) in 0.22, register where the class lives
+        codecs_manager.add_codec(_MDS.__module__, 'MDS', SimpleObjectCodec)
+
+
+# The dissimilarities and SMACOF parameters of the current worker process, set by the pool initializer
+_worker = {}
+
+
+def shared_dissimilarities(X):
+    """Euclidean distances between the rows of X, written in row chunks into one shared buffer."""
+    shared = RawArray(ctypes.c_double, max(len(X) * len(X), 1))
+    dissimilarities = np.frombuffer(shared, dtype=np.float64, count=len(X) * len(X)).reshape(len(X), len(X))
+    step = max(1, DISTANCE_CELLS // max(len(X), 1))
+    for start in range(0, len(X), step):
+        dissimilarities[start:start + step] = euclidean_distances(X[start:start + step], X)
+    # Chunked distances of a row to itself are not exactly 0
+    np.fill_diagonal(dissimilarities, 0)
+    return shared
+
+
+def max_smacof_jobs(n_samples, metric=True):
+    """Number of SMACOF runs whose n x n temporaries fit in SMACOF_CELLS, at least 1."""
+    cells = SMACOF_TEMPORARIES[bool(metric)] * max(n_samples, 1) ** 2
+    return max(1, SMACOF_CELLS // cells)
+
+
+def _init_worker(shared, n_samples, smacof_params):
+    _worker['dissimilarities'] = np.frombuffer(
+        shared, dtype=np.float64, count=n_samples * n_samples).reshape(n_samples, n_samples)
+    _worker['params'] = smacof_params
+
+
+def _worker_smacof(seed):
+    return smacof(_worker['dissimilarities'], n_init=1, random_state=seed, **_worker['params'])
@@ -4,13 +4,25 @@ Copy of existing TFIDF algo but with 2 boolean options added and 3 options set
 so that binary output is achieved.
 '''
 
+from itertools import chain
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer as _HashingVectorizer
 from sklearn.feature_extraction.text import TfidfVectorizer as _TfidfVectorizer
+from sklearn.preprocessing import normalize
 
 from base import BaseAlgo
 from codec import codecs_manager
+from codec.codecs import BaseCodec
 from util import df_util
 from util.param_util import convert_params
 
+# Below this many distinct documents a worker pool costs more than it saves
+PARALLEL_DOCS = 2 ** 12
+
 
 class TFBinary(BaseAlgo):
 
@@ -23,13 +35,21 @@ class TFBinary(BaseAlgo):
 
         out_params = convert_params(
             options.get('params', {}),
-            ints=['max_features'],
-            bools=['use_idf','binary'],
+            ints=['max_features', 'n_features', 'n_jobs'],
+            bools=['use_idf', 'binary', 'hashing'],
             strs=['max_df', 'min_df',
                   'ngram_range', 'stop_words',
-                  'analyzer', 'norm', 'token_pattern'],
+                  'analyzer', 'norm', 'token_pattern',
+                  'output_format'],
         )
 
+        # dense: one float column per term (default)
+        # compact: one column per term built from the sparse matrix, uint8 for binary indicators
+        # indices: a single field listing the indices of the matched terms of each event
+        self.output_format = out_params.pop('output_format', 'dense')
+        if self.output_format not in ('dense', 'compact', 'indices'):
+            raise RuntimeError('output_format must be one of: dense, compact, indices')
+
         for doc_freq, default_val in [('max_df', 1.0), ('min_df', 1)]:
             if doc_freq in out_params:
                 # EAFP... convert max_df/min_df to float/int if it is a number.
@@ -52,15 +72,80 @@ class TFBinary(BaseAlgo):
             except:
                 raise RuntimeError('Syntax Error: ngram_range requires a range, e.g. ngram_range=1-5')
 
-        # TODO: Maybe let the user know that we make this change.
-        out_params.setdefault('max_features', 100)
+        # Tokenize in n_jobs worker processes, -1 uses all cores
+        self.n_jobs = out_params.pop('n_jobs', 1)
+        if self.n_jobs == 0:
+            raise RuntimeError('Invalid value error: n_jobs must not be 0, use -1 for all cores.')
 
         # Binary defaults
         out_params.setdefault('use_idf', False)
         out_params.setdefault('norm', None)
         out_params.setdefault('binary', True)
 
-        self.estimator = _TfidfVectorizer(**out_params)
+        # hashing=true hashes the terms into n_features columns, so there is no
+        # vocabulary to learn or save. Document frequencies are only kept for use_idf.
+        self.hashing = out_params.pop('hashing', False)
+        n_features = out_params.pop('n_features', None)
+        if self.hashing:
+            self.make_hashing_estimator(out_params, n_features)
+        else:
+            if n_features is not None:
+                raise RuntimeError('n_features can only be used with hashing=true')
+            # TODO: Maybe let the user know that we make this change.
+            out_params.setdefault('max_features', 100)
+            self.estimator = _TfidfVectorizer(**out_params)
+
+    def make_hashing_estimator(self, out_params, n_features):
+        for param in ('max_df', 'min_df', 'max_features'):
+            if param in out_params:
+                raise RuntimeError('{} can not be used with hashing=true'.format(param))
+
+        if n_features is None:
+            n_features = 2 ** 10
+        if n_features <= 0:
+            raise RuntimeError('Invalid value error: n_features must be greater than 0, but found n_features="{}".'.format(n_features))
+
+        self.use_idf = out_params.pop('use_idf')
+        self.norm = out_params.pop('norm')
+        self.doc_freq = None
+        self.n_docs = 0
+
+        # Weighting and normalization are applied after hashing, the hasher only counts
+        out_params.update(n_features=n_features, norm=None)
+        if 'alternate_sign' in _HashingVectorizer().get_params():
+            out_params['alternate_sign'] = False
+        else:
+            out_params['non_negative'] = True
+        self.estimator = _HashingVectorizer(**out_params)
+
+    def binary_output(self):
+        if getattr(self, 'hashing', False):
+            return self.estimator.binary and not self.use_idf and self.norm is None
+        return self.estimator.binary and not self.estimator.use_idf and self.estimator.norm is None
+
+    def transform(self, X):
+        y_hat = self.transform_unique(X)
+        if not getattr(self, 'hashing', False):
+            return y_hat
+
+        if self.use_idf:
+            # Same smoothed idf as TfidfTransformer
+            doc_freq = self.doc_freq if self.doc_freq is not None else 0
+            idf = np.log(float(1 + self.n_docs) / (1 + doc_freq)) + 1
+            y_hat = y_hat.dot(sp.diags(idf, 0)).tocsr()
+        if self.norm is not None:
+            y_hat = normalize(y_hat, norm=self.norm, copy=False)
+        return y_hat
+
+    def update_doc_freq(self, X):
+        counts = self.transform_unique(X)
+        counts.sum_duplicates()
+        doc_freq = np.bincount(counts.indices, minlength=counts.shape[1])
+        if self.doc_freq is None:
+            self.doc_freq = doc_freq
+        else:
+            self.doc_freq = self.doc_freq + doc_freq
+        self.n_docs += counts.shape[0]
 
     def fit(self, df, options):
         # Make a copy of data, to not alter original dataframe
@@ -75,11 +160,73 @@ class TFBinary(BaseAlgo):
         )
 
         X = X.values.ravel().astype('str')
-        self.estimator.fit(X)
+        if getattr(self, 'hashing', False):
+            self.doc_freq = None
+            self.n_docs = 0
+            if self.use_idf:
+                self.update_doc_freq(X)
+        else:
+            self.fit_unique(X)
+            # The terms cut by max_df/min_df/max_features are only kept for introspection
+            self.estimator.stop_words_ = None
+
+    def fit_unique(self, X):
+        # Log events repeat a lot, so each distinct document is tokenized once. The vectorizer
+        # is fitted on the document codes with an analyzer returning the cached tokens,
+        # which keeps the counts and document frequencies of the full data.
+        codes, uniques = pd.factorize(X)
+        n_jobs = self.get_n_jobs()
+        if n_jobs > 1 and len(uniques) >= PARALLEL_DOCS:
+            tokens = list(chain.from_iterable(parallel_map(self.estimator, _worker_analyze, uniques, n_jobs)))
+        else:
+            analyze = self.estimator.build_analyzer()
+            tokens = [analyze(doc) for doc in uniques]
+
+        analyzer = self.estimator.analyzer
+        self.estimator.analyzer = tokens.__getitem__
+        try:
+            self.estimator.fit(codes)
+        finally:
+            self.estimator.analyzer = analyzer
+
+    def transform_unique(self, X):
+        # Each distinct document is transformed once and the rows are scattered back with the codes
+        codes, uniques = pd.factorize(X)
+        n_jobs = self.get_n_jobs()
+        if n_jobs > 1 and len(uniques) >= PARALLEL_DOCS:
+            y_hat = sp.vstack(parallel_map(self.estimator, _worker_transform, uniques, n_jobs), format='csr')
+        else:
+            y_hat = self.estimator.transform(uniques).tocsr()
+        if len(uniques) == len(X):
+            return y_hat
+        return y_hat[codes]
+
+    def get_n_jobs(self):
+        n_jobs = getattr(self, 'n_jobs', 1)
+        if n_jobs < 0:
+            n_jobs = max(1, cpu_count() + 1 + n_jobs)
+        return n_jobs
+
+    def partial_fit(self, df, options):
+        if not getattr(self, 'hashing', False):
+            raise RuntimeError('partial_fit requires hashing=true')
+
+        X, _, self.columns = df_util.prepare_features(
+            X=df.copy(),
+            variables=self.feature_variables,
+            get_dummies=False,
+            mlspl_limits=options.get('mlspl_limits'),
+        )
+
+        # Without idf weighting there is nothing to learn
+        if self.use_idf:
+            self.update_doc_freq(X.values.ravel().astype('str'))
 
     def make_output_names(self, options):
         default_name = self.feature_variables[0] + '_tfbin'
         output_name = options.get('output_name', default_name)
+        if getattr(self, 'hashing', False):
+            return [output_name + '_' + str(index) for index in range(self.estimator.n_features)]
         feature_names = self.estimator.get_feature_names()
         output_names = [output_name + '_' + str(index) + '_' + word
                         for (index, word) in enumerate(feature_names)]
@@ -99,26 +246,125 @@ class TFBinary(BaseAlgo):
         )
 
         X = X.values.ravel().astype('str')
-        y_hat = self.estimator.transform(X)
+        y_hat = self.transform(X)
 
-        # Convert the returned sparse matrix into array
-        y_hat = y_hat.toarray()
+        output_format = getattr(self, 'output_format', 'dense')
+        if output_format == 'compact':
+            output = self.make_compact_output(y_hat, nans, options)
+        elif output_format == 'indices':
+            output = self.make_indices_output(y_hat, nans, options)
+        else:
+            # Convert the returned sparse matrix into array
+            y_hat = y_hat.toarray()
 
-        output_names = self.make_output_names(options)
+            output_names = self.make_output_names(options)
 
-        output = df_util.create_output_dataframe(
-            y_hat=y_hat,
-            output_names=output_names,
-            nans=nans,
-        )
+            output = df_util.create_output_dataframe(
+                y_hat=y_hat,
+                output_names=output_names,
+                nans=nans,
+            )
 
         df = df_util.merge_predictions(df, output)
         return df
 
+    def make_compact_output(self, y_hat, nans, options):
+        # Binary indicators fit in uint8, weighted terms in float32.
+        # Events without text match no term, so their row stays at 0.
+        if self.binary_output():
+            dtype = np.uint8
+        else:
+            dtype = np.float32
+
+        rows = np.flatnonzero(~nans)
+        y_hat = y_hat.tocoo()
+        output = np.zeros((len(nans), y_hat.shape[1]), dtype=dtype)
+        output[rows[y_hat.row], y_hat.col] = y_hat.data
+        return pd.DataFrame(output, columns=self.make_output_names(options))
+
+    def make_indices_output(self, y_hat, nans, options):
+        # Space separated term indices, split them with | makemv to get a multivalue field
+        y_hat = y_hat.tocsr()
+        y_hat.sort_indices()
+        terms = np.split(y_hat.indices, y_hat.indptr[1:-1])
+
+        output = np.empty(len(nans), dtype=object)
+        output[:] = ''
+        output[np.flatnonzero(~nans)] = [' '.join(map(str, indices)) for indices in terms]
+
+        output_name = options.get('output_name', self.feature_variables[0] + '_tfbin')
+        return pd.DataFrame({output_name + '_indices': output})
+
     @staticmethod
     def register_codecs():
         from codec.codecs import SimpleObjectCodec
         codecs_manager.add_codec('algos_contrib.TFBinary', 'TFBinary', SimpleObjectCodec)
-        codecs_manager.add_codec('sklearn.feature_extraction.text', 'TfidfVectorizer', SimpleObjectCodec)
+        codecs_manager.add_codec('sklearn.feature_extraction.text', 'TfidfVectorizer', TfidfVectorizerCodec)
         codecs_manager.add_codec('sklearn.feature_extraction.text', 'TfidfTransformer', SimpleObjectCodec)
+        codecs_manager.add_codec('sklearn.feature_extraction.text', 'HashingVectorizer', SimpleObjectCodec)
         codecs_manager.add_codec('scipy.sparse.dia', 'dia_matrix', SimpleObjectCodec)
+
+
+# The vectorizer of the current worker process, set by the pool initializer
+_worker = {}
+
+
+def _init_worker(estimator):
+    _worker['estimator'] = estimator
+    _worker['analyze'] = estimator.build_analyzer()
+
+
+def _worker_transform(docs):
+    return _worker['estimator'].transform(docs).tocsr()
+
+
+def _worker_analyze(docs):
+    analyze = _worker['analyze']
+    return [analyze(doc) for doc in docs]
+
+
+def parallel_map(estimator, func, docs, n_jobs):
+    """Apply func to consecutive chunks of docs in n_jobs worker processes, the results keep the input order."""
+    chunks = np.array_split(docs, 4 * n_jobs)
+    pool = Pool(n_jobs, initializer=_init_worker, initargs=(estimator,))
+    try:
+        return pool.map(func, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class TfidfVectorizerCodec(BaseCodec):
+    """
+    Saves a TfidfVectorizer without stop_words_ and with the vocabulary as a list of terms in column order,
+    so the model size only depends on max_features.
+    """
+    @classmethod
+    def encode(cls, obj):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        assert type(obj) == TfidfVectorizer
+        state = obj.__dict__.copy()
+        state.pop('stop_words_', None)
+        vocabulary = state.pop('vocabulary_', None)
+        if vocabulary is not None:
+            vocabulary = sorted(vocabulary, key=vocabulary.get)
+        return {
+            '__mlspl_type': [type(obj).__module__, type(obj).__name__],
+            'state': state,
+            'vocabulary': vocabulary,
+        }
+
+    @classmethod
+    def decode(cls, obj):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        t = TfidfVectorizer.__new__(TfidfVectorizer)
+        # Models saved with SimpleObjectCodec keep the full __dict__
+        if 'dict' in obj:
+            t.__dict__ = obj['dict']
+            t.stop_words_ = None
+            return t
+        t.__dict__ = obj['state']
+        t.stop_words_ = None
+        if obj['vocabulary'] is not None:
+            t.vocabulary_ = dict(zip(obj['vocabulary'], range(len(obj['vocabulary']))))
+        return t
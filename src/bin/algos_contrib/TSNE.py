@@ -1,6 +1,14 @@
 #!/usr/bin/env python
 
+import re
+
+import numpy as np
+import scipy.sparse as sp
+import sklearn
+from sklearn.decomposition import PCA, TruncatedSVD
 from sklearn.manifold import TSNE as _TSNE
+from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import NearestNeighbors
 
 from base import BaseAlgo, TransformerMixin
 from codec import codecs_manager
@@ -8,23 +16,71 @@ from util.param_util import convert_params
 
 from util import df_util
 
+# Number of distances held in memory at once while placing new points
+TRANSFORM_CELLS = 2 ** 22
+
+SKLEARN_VERSION = tuple(int(v) for v in re.findall(r'\d+', sklearn.__version__)[:2])
+
+# TSNE takes a sparse precomputed neighbours graph since scikit-learn 0.22
+SPARSE_PRECOMPUTED = SKLEARN_VERSION >= (0, 22)
+
+
 class TSNE(TransformerMixin, BaseAlgo):
 
     def __init__(self, options):
         self.handle_options(options)
         out_params = convert_params(
             options.get('params', {}),
-            ints=['k', 'n_iter'],
+            ints=['k', 'n_iter', 'n_neighbors', 'transform_steps', 'pre_components', 'n_trees', 'random_state'],
             floats=['perplexity', 'early_exaggeration', 'learning_rate'],
+            strs=['pre_reduce', 'neighbors'],
             aliases={'k': 'n_components'}
         )
 
+        # Optionally reduce the features to pre_components dimensions with PCA or TruncatedSVD
+        # before computing the affinities, new points in apply go through the same reduction
+        self.pre_reduce = out_params.pop('pre_reduce', 'none')
+        self.pre_components = out_params.pop('pre_components', 50)
+        if self.pre_reduce not in ('none', 'pca', 'svd'):
+            raise RuntimeError('pre_reduce must be one of: none, pca, svd')
+        if self.pre_components < 1:
+            msg = 'Invalid value for pre_components: pre_components must be greater than or equal to 1, but found pre_components="{}".'
+            raise RuntimeError(msg.format(self.pre_components))
+
+        # approximate: the neighbours behind the affinities come from a forest of n_trees random projection trees
+        self.neighbors = out_params.pop('neighbors', 'exact')
+        self.n_trees = out_params.pop('n_trees', 8)
+        if self.neighbors not in ('exact', 'approximate'):
+            raise RuntimeError('neighbors must be one of: exact, approximate')
+        if self.n_trees < 1:
+            msg = 'Invalid value for n_trees: n_trees must be greater than or equal to 1, but found n_trees="{}".'
+            raise RuntimeError(msg.format(self.n_trees))
+        if self.neighbors == 'approximate' and not SPARSE_PRECOMPUTED:
+            raise RuntimeError('neighbors=approximate requires scikit-learn 0.22 or later')
+
+        # New points are placed at the weighted mean of the embedding of their n_neighbors
+        # nearest training points, then moved by transform_steps gradient steps of the t-SNE
+        # cost with the training embedding held fixed
+        self.n_neighbors = out_params.pop('n_neighbors', 10)
+        self.transform_steps = out_params.pop('transform_steps', 0)
+        if self.n_neighbors < 1:
+            msg = 'Invalid value for n_neighbors: n_neighbors must be greater than or equal to 1, but found n_neighbors="{}".'
+            raise RuntimeError(msg.format(self.n_neighbors))
+        if self.transform_steps < 0:
+            msg = 'Invalid value for transform_steps: transform_steps must not be negative, but found transform_steps="{}".'
+            raise RuntimeError(msg.format(self.transform_steps))
+
         if out_params['n_components'] < 1:
             msg = 'Invalid value for k: k must be greater than or equal to 1, but found k="{}".'
             raise RuntimeError(msg.format(out_params['n_components']))
 
         if 'n_iter' not in out_params:
-            out_params.setdefault('n_iter', 200)
+            # scikit-learn 0.22 and later, needed for approximate neighbours, run at least 250 iterations
+            out_params.setdefault('n_iter', 250 if self.neighbors == 'approximate' else 200)
+
+        if self.neighbors == 'approximate' and out_params['n_iter'] < 250:
+            msg = 'Invalid value for n_iter: neighbors=approximate requires n_iter of at least 250, but found n_iter="{}".'
+            raise RuntimeError(msg.format(out_params['n_iter']))
 
         if 'perplexity' not in out_params:
             out_params.setdefault('perplexity', 30.0)
@@ -35,6 +91,10 @@ class TSNE(TransformerMixin, BaseAlgo):
         if 'learning_rate' not in out_params:
             out_params.setdefault('learning_rate', 100)
 
+        # scikit-learn 1.5 renamed n_iter to max_iter
+        if 'n_iter' not in _TSNE().get_params():
+            out_params['max_iter'] = out_params.pop('n_iter')
+
         self.estimator = _TSNE(**out_params)
 
     def rename_output(self, default_names, new_names):
@@ -43,6 +103,44 @@ class TSNE(TransformerMixin, BaseAlgo):
         output_names = ['{}_{}'.format(new_names, i+1) for i in xrange(len(default_names))]
         return output_names
 
+    def fit(self, df, options):
+        # Make a copy of data, to not alter original dataframe
+        X = df.copy()
+
+        X, nans, self.columns = df_util.prepare_features(
+            X=X,
+            variables=self.feature_variables,
+            mlspl_limits=options.get('mlspl_limits'),
+        )
+
+        features = X.values.astype(np.float64)
+        self.reducer = None
+        if self.pre_reduce != 'none' and self.pre_components < features.shape[1]:
+            reducer = PCA if self.pre_reduce == 'pca' else TruncatedSVD
+            self.reducer = reducer(n_components=self.pre_components, random_state=self.estimator.random_state)
+            features = self.reducer.fit_transform(features)
+
+        if self.neighbors == 'approximate':
+            # Same number of neighbours as the barnes_hut affinities
+            n_neighbors = min(len(features) - 1, int(3 * self.estimator.perplexity + 1))
+            graph = random_projection_neighbors(
+                features, n_neighbors, self.n_trees, self.estimator.random_state, include_self=True)
+            # The affinities are computed from squared euclidean distances. Before 1.1 TSNE uses
+            # precomputed distances as they are, later versions square them themselves.
+            if SKLEARN_VERSION < (1, 1):
+                graph.data **= 2
+            estimator = _TSNE(**dict(self.estimator.get_params(), metric='precomputed', init='random'))
+            self.embedding = estimator.fit_transform(graph)
+        else:
+            self.embedding = self.estimator.fit_transform(features)
+
+        # The model keeps the training points and their embedding for apply,
+        # the fitted estimator would only hold a second copy of the embedding
+        self.training = features
+        self.estimator = _TSNE(**self.estimator.get_params())
+
+        return self.make_output(df, self.embedding, nans, options)
+
     def apply(self, df, options):
         # Make a copy of data, to not alter original dataframe
         X = df.copy()
@@ -54,9 +152,45 @@ class TSNE(TransformerMixin, BaseAlgo):
             final_columns=self.columns,
         )
 
-        # Call the transform method
-        y_hat = self.estimator.fit_transform(X.values)
+        if getattr(self, 'embedding', None) is None:
+            # Models saved before the embedding was kept can only be refitted
+            y_hat = self.estimator.fit_transform(X.values)
+        else:
+            X = X.values.astype(np.float64)
+            if getattr(self, 'reducer', None) is not None:
+                X = self.reducer.transform(X)
+            y_hat = self.transform(X)
+
+        return self.make_output(df, y_hat, nans, options)
+
+    def transform(self, X):
+        """Place new points in the training embedding."""
+        n_neighbors = min(self.n_neighbors, len(self.training))
+        n_affinities = n_neighbors
+        if self.transform_steps > 0:
+            # Same neighbourhood size as the exact affinities of t-SNE
+            n_affinities = max(n_neighbors, min(int(3 * self.estimator.perplexity) + 1, len(self.training)))
+        index = NearestNeighbors(n_neighbors=n_affinities).fit(self.training)
+        distances, neighbors = index.kneighbors(X)
+
+        # Inverse distance weights, a point equal to a training point takes its position
+        with np.errstate(divide='ignore'):
+            weights = 1.0 / distances[:, :n_neighbors]
+        exact = np.isinf(weights).any(axis=1)
+        weights[exact] = np.isinf(weights[exact])
+        weights /= weights.sum(axis=1)[:, np.newaxis]
+        y_hat = np.einsum('ij,ijk->ik', weights, self.embedding[neighbors[:, :n_neighbors]])
 
+        if self.transform_steps > 0:
+            affinities = conditional_affinities(distances, min(self.estimator.perplexity, n_affinities - 1))
+            step = max(1, TRANSFORM_CELLS // len(self.embedding))
+            for start in range(0, len(X), step):
+                rows = slice(start, start + step)
+                y_hat[rows] = descend_fixed(y_hat[rows], self.embedding, neighbors[rows],
+                                            affinities[rows], self.transform_steps)
+        return y_hat
+
+    def make_output(self, df, y_hat, nans, options):
         # Assign output_name
         output_name = options.get('output_name', None)
         default_names = self.make_output_names(
@@ -80,4 +214,99 @@ class TSNE(TransformerMixin, BaseAlgo):
     def register_codecs():
         from codec.codecs import SimpleObjectCodec
         codecs_manager.add_codec('algos_contrib.TSNE', 'TSNE', SimpleObjectCodec)
-        codecs_manager.add_codec('sklearn.manifold.t_sne', 'TSNE', SimpleObjectCodec)
+        # The sklearn modules were made private (t_sne -> _t_sne, ...) in 0.22, register where the classes live
+        codecs_manager.add_codec(_TSNE.__module__, 'TSNE', SimpleObjectCodec)
+        codecs_manager.add_codec(PCA.__module__, 'PCA', SimpleObjectCodec)
+        codecs_manager.add_codec(TruncatedSVD.__module__, 'TruncatedSVD', SimpleObjectCodec)
+
+
+def random_projection_neighbors(X, n_neighbors, n_trees, random_state=None, include_self=False):
+    """Approximate nearest neighbours graph of X from a forest of random projection trees.
+
+    Each tree splits the rows at the median of their projection on the direction between two random
+    rows, down to leaves of at most 2 * (n_neighbors + 1) rows. The neighbours of a row are the closest
+    rows sharing one of its leaves. Returns a CSR matrix with the n_neighbors distances of each row,
+    preceded by the row itself at distance 0 with include_self, as scikit-learn expects of a precomputed graph.
+    """
+    rng = np.random.RandomState(random_state)
+    leaf_size = 2 * (n_neighbors + 1)
+    best_indices = np.zeros((len(X), 0), dtype=int)
+    best_distances = np.zeros((len(X), 0))
+
+    for _ in range(n_trees):
+        indices = np.zeros((len(X), n_neighbors), dtype=int)
+        distances = np.zeros((len(X), n_neighbors))
+        nodes = [np.arange(len(X))]
+        while nodes:
+            node = nodes.pop()
+            if len(node) <= leaf_size:
+                leaf_distances = pairwise_distances(X[node])
+                np.fill_diagonal(leaf_distances, np.inf)
+                closest = np.argpartition(leaf_distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+                indices[node] = node[closest]
+                distances[node] = leaf_distances[np.arange(len(node))[:, np.newaxis], closest]
+                continue
+            a, b = X[rng.choice(node, 2, replace=False)]
+            order = np.argsort(X[node].dot(a - b), kind='mergesort')
+            nodes.append(node[order[:len(node) // 2]])
+            nodes.append(node[order[len(node) // 2:]])
+
+        # Merge with the previous trees, a neighbour found by several trees is kept once
+        indices = np.hstack([best_indices, indices])
+        distances = np.hstack([best_distances, distances])
+        rows = np.arange(len(X))[:, np.newaxis]
+        order = np.argsort(indices, axis=1, kind='mergesort')
+        indices, distances = indices[rows, order], distances[rows, order]
+        distances[:, 1:][indices[:, 1:] == indices[:, :-1]] = np.inf
+        closest = np.argpartition(distances, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        best_indices, best_distances = indices[rows, closest], distances[rows, closest]
+
+    order = np.argsort(best_distances, axis=1)
+    rows = np.arange(len(X))[:, np.newaxis]
+    best_indices, best_distances = best_indices[rows, order], best_distances[rows, order]
+    if include_self:
+        best_indices = np.hstack([np.arange(len(X))[:, np.newaxis], best_indices])
+        best_distances = np.hstack([np.zeros((len(X), 1)), best_distances])
+        n_neighbors += 1
+    indptr = np.arange(0, len(X) * n_neighbors + 1, n_neighbors)
+    return sp.csr_matrix((best_distances.ravel(), best_indices.ravel(), indptr), shape=(len(X), len(X)))
+
+
+def conditional_affinities(distances, perplexity, n_steps=100):
+    """Gaussian affinities of each row over its neighbour distances, with the bandwidth set by binary search
+    so that every row has the given perplexity, as in the t-SNE input affinities."""
+    # Shifting by the nearest distance does not change the normalized affinities and avoids underflow
+    squared = distances ** 2
+    squared -= squared.min(axis=1)[:, np.newaxis]
+    target = np.log(perplexity)
+
+    beta = np.ones(len(squared))
+    low = np.zeros(len(squared))
+    high = np.full(len(squared), np.inf)
+    for _ in range(n_steps):
+        affinities = np.exp(-squared * beta[:, np.newaxis])
+        total = affinities.sum(axis=1)
+        entropy = np.log(total) + beta * (squared * affinities).sum(axis=1) / total
+
+        # Too much entropy means too wide a kernel, so increase the precision beta
+        wide = entropy > target
+        low[wide] = beta[wide]
+        high[~wide] = beta[~wide]
+        beta = np.where(np.isinf(high), beta * 2, (low + high) / 2)
+
+    affinities = np.exp(-squared * beta[:, np.newaxis])
+    return affinities / affinities.sum(axis=1)[:, np.newaxis]
+
+
+def descend_fixed(y, embedding, neighbors, affinities, n_steps, learning_rate=1.0):
+    """Gradient descent on KL(P_i || Q_i) for each new point i, with the training embedding held fixed."""
+    rows = np.arange(len(y))[:, np.newaxis]
+    for _ in range(n_steps):
+        squared = ((y[:, np.newaxis, :] - embedding[np.newaxis, :, :]) ** 2).sum(axis=2)
+        kernel = 1.0 / (1.0 + squared)
+        attraction = -kernel / kernel.sum(axis=1)[:, np.newaxis]
+        attraction[rows, neighbors] += affinities
+        attraction *= kernel
+        gradient = 4 * (attraction.sum(axis=1)[:, np.newaxis] * y - attraction.dot(embedding))
+        y = y - learning_rate * gradient
+    return y
@@ -0,0 +1,78 @@
+"""Recall and fit time of the lsh_tables index of CollaborativeFilter against the exact top k path.
+
+Run from src/bin, the table in CollaborativeFilter.py was measured with:
+
+    python -m algos_contrib.tests.bench_lsh --users 20000 --items 5000 --overlap 0.5
+    python -m algos_contrib.tests.bench_lsh --users 20000 --items 5000 --overlap 0.9
+
+Users belong to planted tastes: each user rates an overlap fraction of its taste's items and a few random items,
+so the cosine similarity of two users of the same taste is spread around 0.5 with overlap 0.5 and around 0.8 with
+overlap 0.9.
+"""
+import argparse
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from algos_contrib.CollaborativeFilter import _lsh_top_k_similarity, _top_k_similarity
+
+SETTINGS = [(16, 4), (8, 6), (16, 6), (8, 8), (16, 8), (32, 8), (16, 12), (32, 12)]
+
+
+def planted_ratings(n_users, n_items, overlap=0.5, users_per_taste=20, taste_items=50, noise_items=5,
+                    random_state=0):
+    """Sparse users x items ratings of users rating an overlap fraction of their planted taste's items."""
+    rng = np.random.RandomState(random_state)
+    n_tastes = max(1, n_users // users_per_taste)
+    tastes = np.array([rng.choice(n_items, taste_items, replace=False) for _ in range(n_tastes)])
+    user_taste = rng.randint(n_tastes, size=n_users)
+
+    mask = rng.rand(n_users, taste_items) < overlap
+    rows = np.concatenate([np.nonzero(mask)[0], np.repeat(np.arange(n_users), noise_items)])
+    cols = np.concatenate([tastes[user_taste][mask], rng.randint(n_items, size=n_users * noise_items)])
+
+    # a repeated (user, item) pair is rated once
+    ratings = sp.coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_users, n_items)).tocsr()
+    ratings.data = rng.randint(1, 6, size=ratings.nnz).astype(np.float64)
+    return ratings
+
+
+def recall_at_k(exact, approximate):
+    """Fraction of the exact top k neighbours found by the approximate top k."""
+    exact, approximate = exact.tocsr(), approximate.tocsr()
+    found = 0
+    for row in range(exact.shape[0]):
+        found += len(np.intersect1d(exact[row].indices, approximate[row].indices))
+    return float(found) / max(exact.nnz, 1)
+
+
+def benchmark(n_users, n_items, k=10, overlap=0.5, settings=SETTINGS, random_state=0):
+    """Rows of (tables, bits, recall@k, seconds), starting with the exact path as (None, None, 1.0, seconds)."""
+    ratings = planted_ratings(n_users, n_items, overlap, random_state=random_state)
+    start = time.time()
+    exact = _top_k_similarity(ratings, k)
+    results = [(None, None, 1.0, time.time() - start)]
+    for n_tables, n_bits in settings:
+        start = time.time()
+        approximate = _lsh_top_k_similarity(ratings, k, n_tables, n_bits, random_state)
+        results.append((n_tables, n_bits, recall_at_k(exact, approximate), time.time() - start))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=5000)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--overlap', type=float, default=0.5)
+    args = parser.parse_args()
+
+    print('{:>6} {:>4} {:>9} {:>8}'.format('tables', 'bits', 'recall', 'seconds'))
+    for n_tables, n_bits, recall, seconds in benchmark(args.users, args.items, args.k, args.overlap):
+        print('{:>6} {:>4} {:>9.2f} {:>8.1f}'.format(
+            'exact' if n_tables is None else n_tables, '' if n_bits is None else n_bits, recall, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 from algos_contrib.IsolationForest import IsolationForest
 from test.contrib_util import AlgoTestUtils
 import pandas as pd
+import pytest
 
 def test_algo():
     AlgoTestUtils.assert_algo_basic(IsolationForest, serializable=False)
@@ -20,7 +21,95 @@ def test_algo_options():
     required_methods = (
         '__init__',
         'fit',
+        'partial_fit',
         'apply',
         'register_codecs',
     )
-    AlgoTestUtils.assert_algo_basic(IsolationForest, required_methods=required_methods, input_df=input_df, options=options, serializable=False)
\ No newline at end of file
+    AlgoTestUtils.assert_algo_basic(IsolationForest, required_methods=required_methods, input_df=input_df, options=options, serializable=False)
+
+def test_compiled_forest_matches_estimator():
+    import numpy as np
+    from algos_contrib.IsolationForest import CompiledForest, _IsolationForest
+
+    X = np.random.RandomState(0).randn(500, 4)
+    estimator = _IsolationForest(n_estimators=20, max_features=0.5, random_state=0).fit(X)
+    forest = CompiledForest.from_estimator(estimator, X.shape[1])
+    assert (forest.is_outlier(X) == (estimator.predict(X) == -1)).all()
+
+
+def test_anomaly_score_option():
+    options = {'feature_variables': ['a', 'b'], 'params': {'anomaly_score': 'true'}}
+    assert IsolationForest(options).return_scores is True
+    options = {'feature_variables': ['a', 'b']}
+    assert IsolationForest(options).return_scores is False
+
+
+def test_invalid_replace_trees():
+    options = {'feature_variables': ['a', 'b'], 'params': {'replace_trees': '0'}}
+    with pytest.raises(RuntimeError) as excinfo:
+        _ = IsolationForest(options)
+    assert excinfo.match('replace_trees must be greater than 0')
+
+
+def test_parallel_scores_match_serial(monkeypatch):
+    import numpy as np
+    import algos_contrib.IsolationForest as iforest
+
+    X = np.random.RandomState(0).randn(1000, 4)
+    estimator = iforest._IsolationForest(n_estimators=20, random_state=0).fit(X)
+    forest = iforest.CompiledForest.from_estimator(estimator, X.shape[1])
+    monkeypatch.setattr(iforest, 'PARALLEL_ROWS', 0)
+    assert (forest.scores(X, n_jobs=2) == forest.scores(X)).all()
+
+
+def test_pack_array_round_trip():
+    import json
+    import numpy as np
+    from algos_contrib.IsolationForest import pack_array, unpack_array
+
+    nodes = np.zeros(3, dtype=[('left_child', '<i8'), ('threshold', '<f8'), ('flag', 'u1')])
+    nodes['threshold'] = [0.5, -1.25, 3.0]
+    decoded = unpack_array(json.loads(json.dumps(pack_array(nodes))))
+    assert decoded.dtype == nodes.dtype
+    assert (decoded == nodes).all()
+
+
+def test_float32_floor_keeps_decisions():
+    import numpy as np
+    from algos_contrib.IsolationForest import float32_floor
+
+    thresholds = np.random.RandomState(0).randn(1000)
+    floored = float32_floor(thresholds)
+    X = np.concatenate([floored, np.nextafter(floored, np.float32(np.inf))])
+    assert ((X[:, np.newaxis] <= thresholds) == (X[:, np.newaxis] <= floored)).all()
+
+
+def test_partial_fit_replaces_oldest_trees():
+    import numpy as np
+
+    rng = np.random.RandomState(0)
+    options = {
+        'feature_variables': ['a', 'b'],
+        'params': {'n_estimators': '10', 'replace_trees': '2', 'random_state': '0'},
+    }
+    algo = IsolationForest(options)
+    algo.fit(pd.DataFrame(rng.randn(500, 2), columns=['a', 'b']), {})
+    original = algo.forest
+
+    # chunks smaller than max_samples='auto' grow trees with a smaller c(max_samples)
+    for _ in range(2):
+        algo.partial_fit(pd.DataFrame(rng.randn(100, 2), columns=['a', 'b']), {})
+    forest = algo.forest
+
+    assert len(forest.roots) == 10
+    assert forest.roots[0] == 0
+    kept = slice(original.roots[4], None)
+    n_kept = len(original.feature) - original.roots[4]
+    assert (forest.threshold[:n_kept] == original.threshold[kept]).all()
+    assert (forest.left[:n_kept] == original.left[kept] - original.roots[4]).all()
+    assert (forest.roots[:6] == original.roots[4:] - original.roots[4]).all()
+
+    # every kept tree is still normalized by the c(max_samples) it was grown with
+    assert np.allclose(forest.path_length[:n_kept] / forest.normalizer,
+                       original.path_length[kept] / original.normalizer)
+    assert forest.normalizer < original.normalizer
@@ -1,6 +1,123 @@
-from algos_contrib.AgglomerativeClustering import AgglomerativeClustering
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.cluster import AgglomerativeClustering as AgClustering
+from sklearn.cluster import ward_tree
+from sklearn.metrics import adjusted_rand_score, silhouette_samples
+
+from algos_contrib.AgglomerativeClustering import (
+    AgglomerativeClustering, birch_micro_clusters, cluster_centroids, cut_tree, read_cached_tree,
+    silhouette_scores, write_cached_tree)
 from test.contrib_util import AlgoTestUtils
 
 
 def test_algo():
-    AlgoTestUtils.assert_algo_basic(AgglomerativeClustering, serializable=False)
+    input_df = pd.DataFrame({
+        'a': [1, 2, 3, 10, 11, 12],
+        'b': [4, 5, 6, 1, 2, 3],
+    })
+    options = {
+        'feature_variables': ['a', 'b'],
+    }
+    required_methods = (
+        '__init__',
+        'fit',
+        'apply',
+        'register_codecs',
+    )
+    AlgoTestUtils.assert_algo_basic(AgglomerativeClustering, required_methods, input_df, options)
+
+
+def test_invalid_silhouette():
+    with pytest.raises(RuntimeError):
+        AgglomerativeClustering({'feature_variables': ['a'], 'params': {'silhouette': 'fast'}})
+
+
+def test_silhouette_scores_match_sklearn(monkeypatch):
+    import algos_contrib.AgglomerativeClustering as agglomerative_clustering
+    monkeypatch.setattr(agglomerative_clustering, 'SILHOUETTE_CELLS', 100)
+    X = np.random.RandomState(0).rand(60, 3)
+    labels = np.arange(60) % 4
+    np.testing.assert_allclose(silhouette_scores(X, labels), silhouette_samples(X, labels), atol=1e-8)
+
+
+def test_invalid_n_neighbors():
+    with pytest.raises(RuntimeError):
+        AgglomerativeClustering({'feature_variables': ['a'], 'params': {'n_neighbors': 0}})
+
+
+def test_k_and_distance_threshold_conflict():
+    with pytest.raises(RuntimeError):
+        AgglomerativeClustering({'feature_variables': ['a'], 'params': {'k': 3, 'distance_threshold': 1.0}})
+
+
+def test_invalid_distance_threshold():
+    with pytest.raises(RuntimeError) as excinfo:
+        AgglomerativeClustering({'feature_variables': ['a'], 'params': {'distance_threshold': -1}})
+    assert excinfo.match('distance_threshold must be at least 0')
+
+
+def test_n_neighbors_single_row():
+    algo = AgglomerativeClustering({'feature_variables': ['a', 'b'], 'params': {'n_neighbors': 5}})
+    with pytest.raises(RuntimeError) as excinfo:
+        algo.connectivity_graph(np.array([[1., 2.]]))
+    assert excinfo.match('n_neighbors requires at least 2 points')
+    assert algo.connectivity_graph(np.array([[1., 2.], [3., 4.], [5., 6.]])).nnz == 6
+
+
+def test_cut_tree_matches_estimator():
+    X = np.random.RandomState(0).rand(80, 2)
+    children = ward_tree(X)[0]
+    for k in (2, 5, 9):
+        expected = AgClustering(n_clusters=k).fit_predict(X)
+        assert adjusted_rand_score(expected, cut_tree(children, k)) == 1.0
+
+
+def test_cluster_centroids():
+    X = np.array([[0., 0.], [2., 2.], [10., 10.]])
+    np.testing.assert_array_equal(cluster_centroids(X, np.array([0, 0, 1])), [[1., 1.], [10., 10.]])
+
+
+def test_invalid_micro_clusters():
+    with pytest.raises(RuntimeError):
+        AgglomerativeClustering({'feature_variables': ['a'], 'params': {'micro_clusters': 0}})
+
+
+def test_birch_micro_clusters_budget():
+    X = np.random.RandomState(0).rand(500, 2)
+    assignment, centroids = birch_micro_clusters(X, 20, 0.01)
+    assert len(centroids) <= 20
+    np.testing.assert_allclose(centroids, cluster_centroids(X, assignment))
+
+
+def test_micro_clusters_fit():
+    rng = np.random.RandomState(0)
+    X = np.vstack([rng.randn(300, 2), rng.randn(300, 2) + 10])
+    df = pd.DataFrame(X, columns=['a', 'b'])
+    algo = AgglomerativeClustering({'feature_variables': ['a', 'b'], 'params': {'k': 2, 'micro_clusters': 50}})
+    algo.feature_variables = ['a', 'b']
+    assert algo.silhouette == 'sampled'
+
+    output = algo.fit(df, {})
+    assert len(output) == 600
+    assert adjusted_rand_score(np.repeat([0, 1], 300), output['cluster']) == 1.0
+    assert (output['silhouette_score'] > 0.5).all()
+    assert (algo.apply(df, {})['cluster'] == output['cluster']).all()
+
+
+def test_tree_cache(tmpdir, monkeypatch):
+    import algos_contrib.AgglomerativeClustering as agglomerative_clustering
+    monkeypatch.setattr(agglomerative_clustering, 'TREE_CACHE_SIZE', 2)
+    cache_dir = str(tmpdir.join('trees'))
+    children, distances = np.array([[0, 1], [2, 3]]), np.array([0.5, 1.5])
+    for key in ('a', 'b', 'c'):
+        write_cached_tree(cache_dir, key, children, distances)
+    assert len(tmpdir.join('trees').listdir()) == 2
+
+    cached_children, cached_distances = read_cached_tree(cache_dir, 'c')
+    np.testing.assert_array_equal(cached_children, children)
+    np.testing.assert_array_equal(cached_distances, distances)
+
+    # Object arrays are never unpickled from the cache
+    np.savez(str(tmpdir.join('trees', 'd.npz')), children=np.array([{}], dtype=object), distances=distances)
+    assert read_cached_tree(cache_dir, 'd') is None
@@ -1,6 +1,314 @@
-from algos_contrib.CollaborativeFilter import CollaborativeFilter
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+from algos_contrib.CollaborativeFilter import (
+    CollaborativeFilter, _als, _lsh_top_k_similarity, _ratings_matrix, _top_k_similarity)
+from algos_contrib.tests.bench_lsh import planted_ratings, recall_at_k
 from test.contrib_util import AlgoTestUtils
 
 
 def test_algo():
-    AlgoTestUtils.assert_algo_basic(CollaborativeFilter, serializable=False)
+    input_df = pd.DataFrame({
+        'a': [1, 2, 3],
+        'b': ['x', 'y', 'z'],
+        'c': [4, 0, 6],
+    })
+    options = {
+        'feature_variables': ['b', 'c'],
+        'params': {'user_field': 'b'},
+    }
+    required_methods = (
+        '__init__',
+        'fit',
+        'partial_fit',
+        'apply',
+        'register_codecs',
+    )
+    AlgoTestUtils.assert_algo_basic(CollaborativeFilter, required_methods, input_df, options)
+
+
+def test_item_field_requires_rating_field():
+    algo_options = {'params': {'user_field': 'user', 'item_field': 'item'}}
+    with pytest.raises(RuntimeError) as excinfo:
+        _ = CollaborativeFilter(algo_options)
+    assert excinfo.match('item_field and rating_field must be specified together')
+
+
+def test_invalid_k_neighbors():
+    algo_options = {'params': {'k_neighbors': '0'}}
+    with pytest.raises(RuntimeError) as excinfo:
+        _ = CollaborativeFilter(algo_options)
+    assert excinfo.match('k_neighbors must be greater than 0')
+
+
+def test_invalid_top_n():
+    algo_options = {'params': {'top_n': '0'}}
+    with pytest.raises(RuntimeError) as excinfo:
+        _ = CollaborativeFilter(algo_options)
+    assert excinfo.match('top_n must be greater than 0')
+
+
+def test_als_default_parameter_values():
+    algo_options = {'params': {'rating_type': 'als'}}
+    algo = CollaborativeFilter(algo_options)
+    assert algo.rating_type == 'als'
+    assert algo.factors == 10
+    assert algo.iterations == 10
+    assert algo.regularization == 0.1
+    assert algo.n_jobs == 1
+
+
+def test_invalid_n_jobs():
+    with pytest.raises(RuntimeError) as excinfo:
+        CollaborativeFilter({'params': {'rating_type': 'als', 'n_jobs': '0'}})
+    assert excinfo.match('n_jobs must not be 0')
+    # negative values count back from all cores, as in the other algorithms
+    assert CollaborativeFilter({'params': {'rating_type': 'als', 'n_jobs': '-2'}}).n_jobs == -2
+
+
+def test_invalid_regularization():
+    algo_options = {'params': {'rating_type': 'als', 'regularization': '0'}}
+    with pytest.raises(RuntimeError) as excinfo:
+        _ = CollaborativeFilter(algo_options)
+    assert excinfo.match('regularization must be greater than 0')
+
+
+def test_als_reconstructs_low_rank_ratings():
+    rng = np.random.RandomState(0)
+    ratings = rng.rand(40, 3).dot(rng.rand(3, 30))
+    matrix = sp.csr_matrix(ratings)
+
+    user_factors, item_factors = _als(matrix, 3, 1e-6, 50, random_state=0)
+    assert user_factors.shape == (40, 3)
+    assert item_factors.shape == (30, 3)
+    assert np.allclose(user_factors.dot(item_factors.T), ratings, atol=1e-2)
+
+
+def test_partial_fit_requires_long_item_ratings():
+    algo_options = {'params': {'rating_type': 'user', 'item_field': 'item', 'rating_field': 'rating'}}
+    algo = CollaborativeFilter(algo_options)
+    with pytest.raises(RuntimeError) as excinfo:
+        algo.partial_fit(pd.DataFrame(), {})
+    assert excinfo.match('partial_fit requires item_field, rating_field and rating_type=item')
+
+
+def test_lsh_requires_k_neighbors():
+    algo_options = {'params': {'lsh_tables': '4'}}
+    with pytest.raises(RuntimeError) as excinfo:
+        _ = CollaborativeFilter(algo_options)
+    assert excinfo.match('lsh_tables requires k_neighbors')
+
+
+def test_lsh_recall_at_k():
+    # 100 tastes of 20 users each, every user rates a random 80% of their taste's items
+    rng = np.random.RandomState(0)
+    tastes = rng.rand(100, 400) < 0.05
+    matrix = sp.csr_matrix(tastes[np.repeat(np.arange(100), 20)] * (rng.rand(2000, 400) < 0.8))
+
+    k = 5
+    exact = _top_k_similarity(matrix, k)
+    approximate = _lsh_top_k_similarity(matrix, k, n_tables=16, n_bits=8, random_state=0)
+
+    found = sum(len(set(exact[row].indices) & set(approximate[row].indices)) for row in range(2000))
+    recall = float(found) / exact.nnz
+    assert recall > 0.85
+
+
+def test_lsh_default_bits_recall():
+    # the documented default: 16 tables find most neighbours of cosine ~0.8
+    algo = CollaborativeFilter({'params': {'k_neighbors': '10', 'lsh_tables': '16'}})
+    ratings = planted_ratings(2000, 1000, overlap=0.9)
+    exact = _top_k_similarity(ratings, 10)
+    approximate = _lsh_top_k_similarity(ratings, 10, algo.lsh_tables, algo.lsh_bits, random_state=0)
+    assert recall_at_k(exact, approximate) > 0.9
+
+
+def test_top_k_similarity_matches_brute_force():
+    rng = np.random.RandomState(0)
+    matrix = sp.csr_matrix(rng.rand(50, 20) * (rng.rand(50, 20) < 0.5))
+
+    k = 4
+    top_k = _top_k_similarity(matrix, k, block_size=7)
+
+    normalized = matrix.toarray() / np.linalg.norm(matrix.toarray(), axis=1)[:, np.newaxis]
+    brute = normalized.dot(normalized.T)
+    np.fill_diagonal(brute, -np.inf)
+    for row in range(50):
+        expected = np.argsort(-brute[row], kind='mergesort')[:k]
+        assert set(top_k[row].indices) == set(expected)
+        assert np.allclose(np.sort(top_k[row].data), np.sort(brute[row, expected]))
+
+
+def test_als_large_rows_match_batched(monkeypatch):
+    import algos_contrib.CollaborativeFilter as collaborative_filter
+
+    rng = np.random.RandomState(0)
+    ratings = rng.rand(60, 40) * (rng.rand(60, 40) < 0.3)
+    # a popular item rated by every user
+    ratings[:, 0] = rng.rand(60) + 1
+    matrix = sp.csr_matrix(ratings)
+    batched = _als(matrix, 4, 0.1, 5, random_state=0)
+
+    # every row with more than 2 ratings is over the budget and solved by slices
+    monkeypatch.setattr(collaborative_filter, 'ALS_CELLS', 40)
+    sliced = _als(matrix, 4, 0.1, 5, random_state=0)
+    np.testing.assert_allclose(sliced[0], batched[0])
+    np.testing.assert_allclose(sliced[1], batched[1])
+
+def test_apply_top_n_unseen_items(monkeypatch):
+    import algos_contrib.CollaborativeFilter as collaborative_filter
+
+    rng = np.random.RandomState(0)
+    events = pd.DataFrame({
+        'user': rng.randint(0, 50, 500).astype(str),
+        'item': rng.randint(0, 30, 500).astype(str),
+        'rating': rng.randint(1, 6, 500).astype(float),
+    })
+    options = {'params': {'user_field': 'user', 'item_field': 'item', 'rating_field': 'rating', 'top_n': '5'}}
+
+    # several blocks of users are scored in apply
+    monkeypatch.setattr(collaborative_filter, 'APPLY_CELLS', 100)
+    for rating_type in ('item', 'user'):
+        options['params']['rating_type'] = rating_type
+        algo = CollaborativeFilter(options)
+        algo.feature_variables = ['user', 'item', 'rating']
+        algo.fit(events, {})
+        output = algo.apply(events, {})
+
+        assert list(output.columns) == ['user', 'item', 'predicted_rating', 'rank']
+        seen = set(zip(events['user'], events['item']))
+        assert not any((user, item) in seen for user, item in zip(output['user'], output['item']))
+        for _, recommended in output.groupby('user', sort=False):
+            assert len(recommended) <= 5
+            assert list(recommended['rank']) == list(range(1, len(recommended) + 1))
+            assert (np.diff(recommended['predicted_rating'].values) <= 0).all()
+
+
+def test_lsh_batches_match_single_batch(monkeypatch):
+    import algos_contrib.CollaborativeFilter as collaborative_filter
+
+    rng = np.random.RandomState(0)
+    matrix = sp.csr_matrix(rng.rand(300, 50) * (rng.rand(300, 50) < 0.2))
+    # buckets of about 75 rows are scored as blocks, buckets of about 5 rows pair by pair
+    for n_bits in (2, 6):
+        monkeypatch.setattr(collaborative_filter, 'LSH_PAIRS', 2 ** 20)
+        single = _lsh_top_k_similarity(matrix, 5, n_tables=4, n_bits=n_bits, random_state=0)
+
+        # every block and batch is split many times
+        monkeypatch.setattr(collaborative_filter, 'LSH_PAIRS', 50)
+        batched = _lsh_top_k_similarity(matrix, 5, n_tables=4, n_bits=n_bits, random_state=0)
+        assert (single.indptr == batched.indptr).all()
+        for row in range(300):
+            assert set(single[row].indices) == set(batched[row].indices)
+        np.testing.assert_allclose(single.toarray(), batched.toarray())
+
+
+def test_partial_fit_cooccurrence_matches_full_ratings():
+    first = pd.DataFrame({
+        'user': ['u1', 'u1', 'u2', 'u3'],
+        'item': ['a', 'b', 'b', 'c'],
+        'rating': [5.0, 3.0, 4.0, 2.0],
+    })
+    # u1 comes back with a new item and a repeated one, u4 and item d are new
+    second = pd.DataFrame({
+        'user': ['u1', 'u1', 'u4', 'u2'],
+        'item': ['c', 'a', 'd', 'a'],
+        'rating': [1.0, 2.0, 3.0, 5.0],
+    })
+    options = {'params': {'user_field': 'user', 'item_field': 'item', 'rating_field': 'rating'}}
+    algo = CollaborativeFilter(options)
+    algo.feature_variables = ['user', 'item', 'rating']
+    algo.partial_fit(first, {})
+    algo.partial_fit(second, {})
+
+    events = pd.concat([first, second])
+    ratings, users, items = _ratings_matrix(events['user'].values, events['item'].values, events['rating'].values)
+    columns = [list(items).index(item) for item in algo.items]
+    rows = [list(users).index(user) for user in algo.users]
+    ratings = ratings[rows][:, columns]
+
+    np.testing.assert_allclose(algo.ratings.toarray(), ratings.toarray())
+    np.testing.assert_allclose(algo.cooccurrence.toarray(), ratings.T.dot(ratings).toarray())
+
+
+def test_long_format_fit_matches_wide():
+    wide = pd.DataFrame({
+        'user': ['u1', 'u2', 'u3', 'u4'],
+        'a': [5.0, 0.0, 1.0, 4.0],
+        'b': [3.0, 4.0, 0.0, 0.0],
+        'c': [0.0, 2.0, 5.0, 1.0],
+    })
+    # the 2 of u2 on c is split over two events, the NaN and infinite ratings are dropped
+    long = pd.DataFrame({
+        'user': ['u1', 'u1', 'u2', 'u2', 'u2', 'u3', 'u3', 'u4', 'u4', 'u4', 'u1'],
+        'item': ['a', 'b', 'b', 'c', 'c', 'a', 'c', 'a', 'c', 'b', 'c'],
+        'rating': [5.0, 3.0, 4.0, 1.5, 0.5, 1.0, 5.0, 4.0, 1.0, np.nan, np.inf],
+    })
+
+    for rating_type in ('item', 'user'):
+        dense = CollaborativeFilter({'params': {'user_field': 'user', 'rating_type': rating_type}})
+        dense.feature_variables = ['user', 'a', 'b', 'c']
+        dense.fit(wide, {})
+
+        options = {'params': {
+            'user_field': 'user', 'item_field': 'item', 'rating_field': 'rating', 'rating_type': rating_type}}
+        sparse = CollaborativeFilter(options)
+        sparse.feature_variables = ['user', 'item', 'rating']
+        assert sparse.fit(long, {}) is None
+
+        assert sparse.users == dense.users
+        assert sparse.items == dense.items
+        assert sp.issparse(sparse.ratings) and sp.issparse(sparse.neighbours)
+        np.testing.assert_allclose(sparse.ratings.toarray(), dense.ratings.toarray())
+        np.testing.assert_allclose(sparse.neighbours.toarray(), dense.neighbours.toarray(), atol=1e-12)
+
+
+def test_long_format_model_round_trip():
+    import json
+    from codec import MLSPLDecoder, MLSPLEncoder
+    long = pd.DataFrame({
+        'user': ['u1', 'u1', 'u2', 'u2', 'u3', 'u3', 'u4', 'u4'],
+        'item': ['a', 'b', 'b', 'c', 'a', 'c', 'a', 'd'],
+        'rating': [5.0, 3.0, 4.0, 2.0, 1.0, 5.0, 4.0, 1.0],
+    })
+    options = {'params': {
+        'user_field': 'user', 'item_field': 'item', 'rating_field': 'rating', 'k_neighbors': '2', 'top_n': '2'}}
+    CollaborativeFilter.register_codecs()
+    algo = CollaborativeFilter(options)
+    algo.feature_variables = ['user', 'item', 'rating']
+    algo.fit(long, {})
+
+    # the sparse ratings and neighbourhood are saved as csr matrices
+    decoded = json.loads(json.dumps(algo, cls=MLSPLEncoder), cls=MLSPLDecoder)
+    assert sp.isspmatrix_csr(decoded.ratings) and sp.isspmatrix_csr(decoded.neighbours)
+    expected = algo.apply(long.copy(), options)
+    assert decoded.apply(long.copy(), options).equals(expected)
+
+
+def test_wide_fit_weights_by_cosine_similarity():
+    from sklearn.metrics.pairwise import cosine_similarity
+    wide = pd.DataFrame({
+        'user': ['u1', 'u2', 'u3', 'u4'],
+        'a': [5.0, 0.0, 1.0, 4.0],
+        'b': [3.0, 4.0, 0.0, 0.0],
+        'c': [0.0, 2.0, 5.0, 1.0],
+        'd': [0.0, 0.0, 0.0, 0.0],
+    })
+    matrix = wide[['a', 'b', 'c', 'd']].values
+
+    for rating_type in ('item', 'user'):
+        algo = CollaborativeFilter({'params': {'user_field': 'user', 'rating_type': rating_type}})
+        algo.feature_variables = ['user', 'a', 'b', 'c', 'd']
+        output = algo.fit(wide.copy(), {})
+
+        # the same similarities weight the fit output and are kept for apply
+        similarity = cosine_similarity(matrix.T if rating_type == 'item' else matrix)
+        np.testing.assert_allclose(algo.neighbours.toarray(), similarity - np.diag(np.diag(similarity)))
+        weights = similarity / np.maximum(np.abs(similarity).sum(axis=1), 1e-300)[:, np.newaxis]
+        if rating_type == 'item':
+            expected = matrix.dot(weights.T)
+        else:
+            mean = matrix.mean(axis=1)[:, np.newaxis]
+            expected = mean + weights.dot(matrix - mean)
+        np.testing.assert_allclose(output[['a', 'b', 'c', 'd']].values.astype(float), expected, atol=1e-12)
@@ -1,6 +1,73 @@
-from algos_contrib.MDS import MDS
+import pytest
+from algos_contrib.MDS import MDS, max_smacof_jobs
 from test.contrib_util import AlgoTestUtils
 
 
 def test_algo():
-    AlgoTestUtils.assert_algo_basic(MDS, serializable=False)
+    import pandas as pd
+    input_df = pd.DataFrame({
+        'a': [1, 2, 3, 4, 5, 6],
+        'b': [4, 5, 6, 1, 2, 3],
+        'c': [7, 1, 8, 2, 9, 3],
+    })
+    # landmark models are saved and reused by apply
+    options = {
+        'feature_variables': ['b', 'c'],
+        'params': {'k': '2', 'landmarks': '4', 'random_state': '0'},
+    }
+    AlgoTestUtils.assert_algo_basic(MDS, input_df=input_df, options=options)
+
+
+def test_invalid_landmarks():
+    with pytest.raises(RuntimeError):
+        MDS({'feature_variables': ['a', 'b'], 'params': {'k': '2', 'landmarks': '2'}})
+
+
+def test_landmarks_require_metric():
+    with pytest.raises(RuntimeError):
+        MDS({'feature_variables': ['a', 'b'], 'params': {'k': '2', 'landmarks': '10', 'metric': 'false'}})
+
+
+def test_parallel_restarts_match_serial():
+    import numpy as np
+    X = np.random.RandomState(0).rand(30, 3)
+    params = {'k': '2', 'n_init': '3', 'random_state': '0'}
+    serial = MDS({'feature_variables': ['a', 'b', 'c'], 'params': dict(params, n_jobs='1')})
+    parallel = MDS({'feature_variables': ['a', 'b', 'c'], 'params': dict(params, n_jobs='3')})
+    np.testing.assert_array_equal(serial.restarts(X), parallel.restarts(X))
+
+
+def test_max_smacof_jobs():
+    assert max_smacof_jobs(1000) == 2 ** 28 // (6 * 1000 ** 2)
+    assert max_smacof_jobs(1000, metric=False) < max_smacof_jobs(1000)
+    assert max_smacof_jobs(10 ** 6) == 1
+
+
+def test_landmarks_on_every_row_match_classical_mds():
+    import numpy as np
+    import pandas as pd
+    X = np.random.RandomState(0).rand(40, 3)
+    df = pd.DataFrame(X, columns=['a', 'b', 'c'])
+    algo = MDS({'feature_variables': ['a', 'b', 'c'], 'params': {'k': '2', 'landmarks': '40'}})
+    algo.fit(df, {})
+
+    # classical MDS: top eigenvectors of the double centered squared distances scaled by sqrt(eigenvalues)
+    squared = ((X[:, np.newaxis] - X) ** 2).sum(axis=2)
+    centering = np.eye(40) - 1.0 / 40
+    eigenvalues, eigenvectors = np.linalg.eigh(-0.5 * centering.dot(squared).dot(centering))
+    expected = eigenvectors[:, ::-1][:, :2] * np.sqrt(eigenvalues[::-1][:2])
+
+    y_hat = algo.triangulate(X)
+    signs = np.sign((y_hat * expected).sum(axis=0))
+    np.testing.assert_allclose(y_hat * signs, expected, atol=1e-8)
+
+
+def test_landmarks_apply_returns_fit_coordinates():
+    import numpy as np
+    import pandas as pd
+    df = pd.DataFrame(np.random.RandomState(0).rand(100, 3), columns=['a', 'b', 'c'])
+    algo = MDS({'feature_variables': ['a', 'b', 'c'], 'params': {'k': '2', 'landmarks': '20', 'random_state': '0'}})
+    fitted = algo.fit(df, {})
+    applied = algo.apply(df, {})
+    columns = ['MDS_1', 'MDS_2']
+    np.testing.assert_allclose(applied[columns].values.astype(float), fitted[columns].values.astype(float))
@@ -1,6 +1,187 @@
+import pytest
+
 from algos_contrib.TFBinary import TFBinary
 from test.contrib_util import AlgoTestUtils
 
 
 def test_algo():
     AlgoTestUtils.assert_algo_basic(TFBinary, serializable=False)
+
+
+def test_invalid_output_format():
+    with pytest.raises(RuntimeError):
+        TFBinary({'feature_variables': ['text'], 'params': {'output_format': 'sparse'}})
+
+
+def test_n_features_requires_hashing():
+    with pytest.raises(RuntimeError):
+        TFBinary({'feature_variables': ['text'], 'params': {'n_features': 16}})
+
+
+def test_hashing_rejects_vocabulary_params():
+    with pytest.raises(RuntimeError):
+        TFBinary({'feature_variables': ['text'], 'params': {'hashing': True, 'max_features': 16}})
+
+
+def test_invalid_n_jobs():
+    with pytest.raises(RuntimeError):
+        TFBinary({'feature_variables': ['text'], 'params': {'n_jobs': 0}})
+
+
+def test_parallel_transform_matches_serial(monkeypatch):
+    import numpy as np
+    import algos_contrib.TFBinary as tf_binary
+    docs = np.array(['disk {} full on host{}'.format(i % 7, i % 13) for i in range(200)], dtype=object)
+
+    serial = TFBinary({'feature_variables': ['text'], 'params': {'use_idf': True, 'norm': 'l2'}})
+    serial.fit_unique(docs)
+
+    monkeypatch.setattr(tf_binary, 'PARALLEL_DOCS', 0)
+    parallel = TFBinary({'feature_variables': ['text'], 'params': {'use_idf': True, 'norm': 'l2', 'n_jobs': 2}})
+    parallel.fit_unique(docs)
+
+    assert parallel.estimator.vocabulary_ == serial.estimator.vocabulary_
+    assert (parallel.transform(docs) != serial.transform(docs)).nnz == 0
+
+
+def test_tfidf_vectorizer_codec_round_trip():
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from algos_contrib.TFBinary import TfidfVectorizerCodec
+    docs = ['error disk full', 'disk ok', 'login failed for admin', 'login ok', 'error login']
+    vectorizer = TfidfVectorizer(max_features=4).fit(docs)
+
+    encoded = TfidfVectorizerCodec.encode(vectorizer)
+    assert 'stop_words_' not in encoded['state']
+    assert 'vocabulary_' not in encoded['state']
+
+    decoded = TfidfVectorizerCodec.decode(encoded)
+    assert decoded.stop_words_ is None
+    assert decoded.vocabulary_ == vectorizer.vocabulary_
+    assert np.array_equal(decoded.transform(docs).toarray(), vectorizer.transform(docs).toarray())
+
+    # models saved with SimpleObjectCodec keep the whole __dict__
+    legacy = TfidfVectorizerCodec.decode({'dict': dict(vectorizer.__dict__)})
+    assert legacy.stop_words_ is None
+    assert legacy.vocabulary_ == vectorizer.vocabulary_
+    assert np.array_equal(legacy.transform(docs).toarray(), vectorizer.transform(docs).toarray())
+
+
+def test_unique_fit_transform_matches_vectorizer():
+    import numpy as np
+    from sklearn.base import clone
+    docs = np.array(['disk {} full on host{}'.format(i % 7, i % 13) for i in range(500)], dtype=object)
+
+    algo = TFBinary({'feature_variables': ['text'], 'params': {'use_idf': True, 'norm': 'l2', 'min_df': 2}})
+    vectorizer = clone(algo.estimator).fit(docs)
+    algo.fit_unique(docs)
+
+    assert algo.estimator.vocabulary_ == vectorizer.vocabulary_
+    assert np.allclose(algo.estimator.idf_, vectorizer.idf_)
+    assert np.allclose(algo.transform_unique(docs).toarray(), vectorizer.transform(docs).toarray())
+
+
+def apply_formats(params, docs):
+    """apply output of every output_format for a model fitted with params on docs."""
+    import pandas as pd
+    df = pd.DataFrame({'text': docs})
+    outputs = {}
+    for output_format in ('dense', 'compact', 'indices'):
+        algo = TFBinary({'feature_variables': ['text'], 'params': dict(params, output_format=output_format)})
+        algo.feature_variables = ['text']
+        algo.fit(df.dropna(), {})
+        outputs[output_format] = algo.apply(df.copy(), {})
+    return outputs
+
+
+def test_compact_and_indices_match_dense():
+    import numpy as np
+    docs = ['error disk full', None, 'disk ok', 'login failed for admin', 'error login error']
+    outputs = apply_formats({}, docs)
+    columns = [column for column in outputs['dense'] if column.startswith('text_tfbin_')]
+    dense = outputs['dense'][columns].values.astype(float)
+    compact = outputs['compact'][columns]
+
+    # compact keeps binary indicators as uint8, null text rows are 0 rather than NaN
+    assert list(compact.columns) == columns
+    assert (compact.dtypes == np.uint8).all()
+    assert np.isnan(dense[1]).all()
+    assert (compact.values[1] == 0).all()
+    present = [0, 2, 3, 4]
+    assert (compact.values[present] == dense[present]).all()
+
+    # indices lists the matched columns of every row, null text rows are empty
+    indices = outputs['indices']['text_tfbin_indices']
+    assert indices[1] == ''
+    for row in present:
+        assert indices[row] == ' '.join(str(column) for column in np.flatnonzero(dense[row]))
+
+
+def test_compact_weighted_output_is_float32():
+    import numpy as np
+    docs = ['error disk full', 'disk ok', None, 'login failed for admin', 'error login error']
+    outputs = apply_formats({'use_idf': True, 'norm': 'l2'}, docs)
+    columns = [column for column in outputs['dense'] if column.startswith('text_tfbin_')]
+    compact = outputs['compact'][columns]
+
+    assert (compact.dtypes == np.float32).all()
+    assert (compact.values[2] == 0).all()
+    present = [0, 1, 3, 4]
+    np.testing.assert_allclose(compact.values[present], outputs['dense'][columns].values[present].astype(float),
+                               rtol=1e-6)
+
+
+def hashing_docs():
+    return ['disk {} full on host{}'.format(i % 7, i % 13) for i in range(60)] + ['login failed', 'login ok']
+
+
+def test_hashing_partial_fit_matches_fit():
+    import numpy as np
+    import pandas as pd
+    docs = pd.DataFrame({'text': hashing_docs()})
+    params = {'hashing': True, 'use_idf': True, 'norm': 'l2', 'n_features': 64}
+
+    fitted = TFBinary({'feature_variables': ['text'], 'params': params})
+    fitted.feature_variables = ['text']
+    fitted.fit(docs, {})
+
+    updated = TFBinary({'feature_variables': ['text'], 'params': params})
+    updated.feature_variables = ['text']
+    for chunk in np.array_split(np.arange(len(docs)), 3):
+        updated.partial_fit(docs.iloc[chunk], {})
+
+    assert updated.n_docs == fitted.n_docs == len(docs)
+    np.testing.assert_array_equal(updated.doc_freq, fitted.doc_freq)
+
+
+def test_hashing_idf_and_norm():
+    import numpy as np
+    import pandas as pd
+    from sklearn.feature_extraction.text import TfidfTransformer
+    docs = hashing_docs()
+    algo = TFBinary({'feature_variables': ['text'], 'params': {'hashing': True, 'use_idf': True, 'norm': 'l2'}})
+    algo.feature_variables = ['text']
+    algo.fit(pd.DataFrame({'text': docs[:40]}), {})
+
+    # the idf comes from the fitted documents only, rows are then l2 normalized
+    transformer = TfidfTransformer(norm='l2').fit(algo.estimator.transform(docs[:40]))
+    expected = transformer.transform(algo.estimator.transform(docs)).toarray()
+    np.testing.assert_allclose(algo.transform(np.array(docs)).toarray(), expected)
+
+
+def test_hashing_model_round_trip():
+    import json
+    import numpy as np
+    import pandas as pd
+    from codec import MLSPLDecoder, MLSPLEncoder
+    df = pd.DataFrame({'text': hashing_docs()})
+    options = {'feature_variables': ['text'], 'params': {'hashing': True, 'use_idf': True, 'n_features': 32}}
+    TFBinary.register_codecs()
+    algo = TFBinary(options)
+    algo.feature_variables = ['text']
+    algo.fit(df.copy(), options)
+
+    decoded = json.loads(json.dumps(algo, cls=MLSPLEncoder), cls=MLSPLDecoder)
+    np.testing.assert_array_equal(decoded.doc_freq, algo.doc_freq)
+    expected = algo.apply(df.copy(), options).values
+    np.testing.assert_array_equal(decoded.apply(df.copy(), options).values, expected)
@@ -1,5 +1,7 @@
+import numpy as np
+import pandas as pd
 import pytest
-from algos_contrib.TSNE import TSNE
+from algos_contrib.TSNE import SPARSE_PRECOMPUTED, TSNE, conditional_affinities, random_projection_neighbors
 from test.contrib_util import AlgoTestUtils
 
 algo_options = {'feature_variables': ['Review']}
@@ -36,3 +38,96 @@ def test_default_parameter_values():
     assert TSNE_algo.estimator.perplexity == 30.0
     assert TSNE_algo.estimator.early_exaggeration == 4.0
     assert TSNE_algo.estimator.learning_rate == 100
+
+
+def test_invalid_params_n_neighbors_not_valid():
+    algo_options['params'] = {'k': '2', 'n_neighbors': '0'}
+    with pytest.raises(RuntimeError):
+        _ = TSNE(algo_options)
+
+
+def test_conditional_affinities_perplexity():
+    distances = np.sort(np.random.RandomState(0).rand(5, 30) * 4, axis=1)
+    affinities = conditional_affinities(distances, 10.0)
+    np.testing.assert_allclose(affinities.sum(axis=1), 1)
+    np.testing.assert_allclose(np.exp(-(affinities * np.log(affinities)).sum(axis=1)), 10.0, rtol=1e-6)
+
+
+def test_invalid_params_pre_reduce():
+    algo_options['params'] = {'k': '2', 'pre_reduce': 'ica'}
+    with pytest.raises(RuntimeError):
+        _ = TSNE(algo_options)
+
+
+def test_random_projection_neighbors_recall():
+    from sklearn.neighbors import NearestNeighbors
+    X = np.random.RandomState(0).rand(400, 3)
+    graph = random_projection_neighbors(X, 5, 8, random_state=0)
+    assert graph.shape == (400, 400) and graph.nnz == 400 * 5
+
+    _, exact = NearestNeighbors(n_neighbors=6).fit(X).kneighbors(X)
+    found = graph.indices.reshape(400, 5)
+    recall = np.mean([len(set(a) & set(b[1:])) / 5.0 for a, b in zip(found, exact)])
+    assert recall > 0.9
+
+
+@pytest.mark.skipif(not SPARSE_PRECOMPUTED, reason='neighbors=approximate requires scikit-learn 0.22 or later')
+def test_approximate_neighbors_fit_apply():
+    rng = np.random.RandomState(0)
+    X = np.vstack([rng.randn(60, 4), rng.randn(60, 4) + 8])
+    df = pd.DataFrame(X, columns=['a', 'b', 'c', 'd'])
+    options = {'feature_variables': ['a', 'b', 'c', 'd'],
+               'params': {'k': '2', 'perplexity': '5', 'neighbors': 'approximate', 'pre_reduce': 'pca',
+                          'pre_components': '3', 'random_state': '0'}}
+    algo = TSNE(options)
+    assert algo.estimator.get_params().get('n_iter', algo.estimator.get_params().get('max_iter')) == 250
+
+    algo.fit(df.copy(), options)
+    assert algo.embedding.shape == (120, 2)
+    assert algo.training.shape == (120, 3)
+    # The two blobs stay apart in the embedding
+    centers = [algo.embedding[:60].mean(axis=0), algo.embedding[60:].mean(axis=0)]
+    assert np.linalg.norm(centers[0] - centers[1]) > algo.embedding[:60].std(axis=0).sum()
+
+    output = algo.apply(df.copy(), options)
+    assert len(output) == 120
+    np.testing.assert_allclose(algo.transform(algo.reducer.transform(X)), algo.embedding)
+
+
+def test_apply_on_training_rows_returns_embedding():
+    rng = np.random.RandomState(0)
+    df = pd.DataFrame(np.vstack([rng.randn(40, 3), rng.randn(40, 3) + 6]), columns=['a', 'b', 'c'])
+    options = {'feature_variables': ['a', 'b', 'c'],
+               'params': {'k': '2', 'perplexity': '5', 'n_iter': '250', 'random_state': '0'}}
+    algo = TSNE(options)
+    fitted = algo.fit(df.copy(), options)
+    applied = algo.apply(df.copy(), options)
+
+    columns = ['TSNE_1', 'TSNE_2']
+    np.testing.assert_allclose(applied[columns].values.astype(float), algo.embedding)
+    np.testing.assert_allclose(applied[columns].values.astype(float), fitted[columns].values.astype(float))
+
+
+def test_transform_steps_do_not_increase_kl():
+    rng = np.random.RandomState(0)
+    X = np.vstack([rng.randn(60, 3), rng.randn(60, 3) + 6])
+    new = np.vstack([rng.randn(10, 3), rng.randn(10, 3) + 6])
+    options = {'feature_variables': ['a', 'b', 'c'],
+               'params': {'k': '2', 'perplexity': '5', 'n_iter': '250', 'random_state': '0'}}
+    algo = TSNE(options)
+    algo.fit(pd.DataFrame(X, columns=['a', 'b', 'c']), options)
+
+    # KL(P_i || Q_i) of every new point against the fixed training embedding
+    n_affinities = int(3 * algo.estimator.perplexity) + 1
+    distances = np.sqrt(((new[:, np.newaxis] - X) ** 2).sum(axis=2))
+    neighbors = np.argsort(distances, axis=1)[:, :n_affinities]
+    p = conditional_affinities(distances[np.arange(20)[:, np.newaxis], neighbors], algo.estimator.perplexity)
+
+    def kl(y):
+        kernel = 1.0 / (1.0 + ((y[:, np.newaxis] - algo.embedding) ** 2).sum(axis=2))
+        q = kernel / kernel.sum(axis=1)[:, np.newaxis]
+        return (p * np.log(p / q[np.arange(20)[:, np.newaxis], neighbors])).sum()
+
+    interpolated = kl(algo.transform(new))
+    algo.transform_steps = 50
+    assert kl(algo.transform(new)) <= interpolated